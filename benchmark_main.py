@@ -0,0 +1,363 @@
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import typing
+from collections import deque
+
+from chessServer import AsyncServer
+from chessServer import Server
+from chessServer.framing import FrameBuffer
+from chessServer.shared import ETX, PROGRAM_VERSION
+from chessServer.test import ChunkSocket
+from chessServer.user import User
+
+
+class StrBuffer:
+    # the framing used before FrameBuffer: 256 byte reads decoded on their own, count and split per message
+
+    def __init__(self, skt: ChunkSocket):
+        self.socket = skt
+        self.data = ''
+
+    def receive(self) -> int:
+        data = self.socket.recv(256).decode()
+        self.data += data
+        return len(data)
+
+    def next_message(self) -> str:
+        if self.data.count(ETX) == 0:
+            return ''
+        msg, self.data = self.data.split(ETX, 1)
+        return msg
+
+
+def bench_framing(frames: int = 20000) -> None:
+    # a burst of small frames, e.g. a client replaying moves. read in 256 byte chunks and in one piece:
+    data = ''.join(f'%MOVE {i % 9999:04d}{ETX}' for i in range(frames)).encode('utf-8')
+
+    t0 = time.perf_counter()
+    old = StrBuffer(ChunkSocket(data))
+    old_count = 0
+    while old.receive():
+        while old.next_message():
+            old_count += 1
+    old_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    old = StrBuffer(ChunkSocket(b''))
+    old.data = data.decode()  # e.g. the messages buffered during the admittance
+    old_burst_count = 0
+    while old.next_message():
+        old_burst_count += 1
+    old_burst_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    skt = ChunkSocket(data)
+    new = FrameBuffer()
+    new_count = 0
+    while new.receive(skt):
+        new_count += len(new.messages())
+    new_time = time.perf_counter() - t0
+
+    print(f'framing - {frames} frames / {len(data)} bytes')
+    print(f'str buffer:   {old_count} frames in {1000 * old_time:.1f}ms')
+    print(f'str buffer:   {old_burst_count} buffered frames in {1000 * old_burst_time:.1f}ms')
+    print(f'frame buffer: {new_count} frames in {1000 * new_time:.1f}ms (receive size {FrameBuffer.RECEIVE_SIZE})')
+
+    # a multi-byte character split between two reads:
+    text = 'x' * 255 + 'üße'
+    data = (text + ETX).encode('utf-8')
+    try:
+        old = StrBuffer(ChunkSocket(data))
+        old.receive()
+        old.receive()
+        old_result = 'ok' if old.next_message() == text else 'wrong'
+    except UnicodeDecodeError:
+        old_result = 'UnicodeDecodeError'
+    skt = ChunkSocket(data)
+    new = FrameBuffer()
+    FrameBuffer.RECEIVE_SIZE, receive_size = 256, FrameBuffer.RECEIVE_SIZE
+    new.receive(skt)
+    new.receive(skt)
+    FrameBuffer.RECEIVE_SIZE = receive_size
+    new_result = 'ok' if new.next_message() == text else 'wrong'
+    print(f'umlaut across reads - str buffer: {old_result} / frame buffer: {new_result}')
+
+    # an invalid byte only replaces a character of its own message:
+    new = FrameBuffer()
+    new.feed(('first' + ETX).encode('utf-8') + b'\xff\xfe' + ETX.encode('utf-8') + ('last' + ETX).encode('utf-8'))
+    print(f'invalid bytes - frame buffer: {new.messages()}')
+
+
+class DictUser:
+    # the layout of User before the slots: a __dict__, the login formatted at once and the buffers of a
+    # connection allocated for every user, online or not
+
+    def __init__(self, attr: tuple):
+        [self.id, self.ip, self.name, self.password, self.played_games, self.scoring_zero, self.scoring_half,
+         self.scoring_one, self.rating, self.elo_weight, _] = attr
+        self.socket = None
+        self.last_login = time.strftime('%Y.%m.%d.%H:%M:%S')
+        self.on_pending = None
+        self.dirty = False
+        self.buffer = FrameBuffer()
+        self.out = bytearray()
+        self.out_lock = threading.Lock()
+        self.messages = deque()
+
+
+def bench_memory(users: int = 100000) -> None:
+    # bytes per offline user, e.g. the users of the leaderboard and the cache
+    rows = [(i, '127.0.0.1', f'user{i}', 'password', 10, 3, 2, 5, 1010, 30, '2021.03.04.05:06:07')
+            for i in range(users)]
+    results = dict()
+    for name, create in (('dict user', DictUser), ('slots user', User.create_user)):
+        tracemalloc.start()
+        objects = [create(row) for row in rows]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[name] = size / users
+        del objects
+    print(f'memory - {users} offline users')
+    for name, size in results.items():
+        print(f'{name}: {size:.0f} bytes per user')
+
+
+def option(name: str, default: int) -> int:
+    # removes --name value from the arguments
+    if name not in sys.argv:
+        return default
+    index = sys.argv.index(name)
+    try:
+        value = int(sys.argv[index + 1])
+    except (IndexError, ValueError):
+        print(f'{name} needs a number')
+        exit(-1)
+    del sys.argv[index:index + 2]
+    return value
+
+
+def raise_file_limit() -> None:
+    # every simulated player holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    # nearest rank of sorted values, 0 for no values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def rss_mb() -> float:
+    # peak resident set size of this process
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, kilobytes otherwise
+
+
+def run_players(first: int, count: int, port: int, rounds: int, barrier, results) -> None:
+    # one load generating process: signs in count players, links them and relays moves between their opponents.
+    # the phases of all processes start together
+    raise_file_limit()
+    selector = selectors.DefaultSelector()
+    buffers: typing.Dict[socket.socket, FrameBuffer] = dict()
+    started: typing.Dict[socket.socket, float] = dict()
+    login_times, link_times, latencies = list(), list(), list()
+
+    def pump(handle: typing.Callable[[socket.socket, str, float], None], done: typing.Callable[[], bool],
+             deadline: float) -> None:
+        while not done() and time.time() < deadline:
+            for key, _ in selector.select(0.1):
+                skt = key.fileobj
+                try:
+                    received = buffers[skt].receive(skt)
+                except OSError:
+                    received = 0
+                now = time.time()
+                if not received:
+                    selector.unregister(skt)
+                    continue
+                for message in buffers[skt].messages():
+                    handle(skt, message, now)
+
+    barrier.wait()
+    login_start = time.time()
+    for n in range(first, first + count):
+        skt = socket.create_connection(('127.0.0.1', port))
+        skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        started[skt] = time.time()
+        skt.sendall(f'auth{ETX}%NAME player_{n}{ETX}pw{ETX}'.encode('utf-8'))
+        buffers[skt] = FrameBuffer()
+        selector.register(skt, selectors.EVENT_READ)
+
+    def welcome(skt: socket.socket, message: str, now: float):
+        if message.startswith('WELCOME'):
+            login_times.append(now - started[skt])
+
+    pump(welcome, lambda: len(login_times) == count, time.time() + 60)
+    login_end = time.time()
+
+    barrier.wait()
+    for skt in buffers:
+        started[skt] = time.time()
+        skt.sendall(f'%SERVER LINK{ETX}'.encode('utf-8'))
+
+    def linked(skt: socket.socket, message: str, now: float):
+        if message.startswith('%NAME '):
+            link_times.append(now - started[skt])
+
+    pump(linked, lambda: len(link_times) == count, time.time() + Server.LINK_INTERVAL + 10)
+
+    barrier.wait()
+
+    def moved(_, message: str, now: float):
+        # the moves carry the time they were sent, the link messages negative codes
+        value = message[6:] if message.startswith('%MOVE ') else ''
+        if value.isdigit():
+            latencies.append(now - int(value) / 1e9)
+
+    for _ in range(rounds):
+        for key in list(selector.get_map().values()):
+            key.fileobj.sendall(f'%MOVE {time.time_ns()}{ETX}'.encode('utf-8'))
+        pump(moved, lambda: False, time.time() + 0.1)
+    pump(moved, lambda: len(latencies) >= len(link_times) * rounds, time.time() + 10)
+
+    results.put({
+        'login_start': login_start, 'login_end': login_end, 'login_times': login_times,
+        'link_times': link_times, 'latencies': latencies,
+    })
+    barrier.wait()  # keep the connections until every process has measured
+    for skt in buffers:
+        skt.close()
+
+
+def bench_load(server_class: typing.Type[Server] = Server, players: int = 2000, processes: int = 4,
+               rounds: int = 20) -> None:
+    # drives simulated players against a server on loopback and writes the results as json
+    players -= players % (2 * processes)  # every process links an even number of players
+    output = os.path.abspath(f'benchmark_load_{server_class.__name__}.json')
+
+    raise_file_limit()
+    Server.MAX_PER_IP = players  # all players connect from 127.0.0.1
+    Server.ACCEPT_LIMIT_IP = Server.ACCEPT_LIMIT_PREFIX = Server.ACCEPT_LIMIT = None
+    cwd, stdin = os.getcwd(), sys.stdin
+    sys.stdin = open(os.devnull)  # the server gets no console
+    directory = tempfile.TemporaryDirectory()
+    os.chdir(directory.name)  # the server creates its data directory here
+    server = server_class('127.0.0.1', 56600, 'auth', 'pw')
+    server.run()
+    time.sleep(0.1)
+    rss_before = rss_mb()
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    count = players // processes
+    workers = [context.Process(target=run_players, args=(n * count, count, server.get_port(), rounds, barrier, results))
+               for n in range(processes)]
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    wall_before = time.time()
+    for worker in workers:
+        worker.start()
+    measurements = list()
+    while len(measurements) < processes:
+        try:
+            measurements.append(results.get(timeout=1))
+        except queue.Empty:
+            if not all(worker.is_alive() for worker in workers):
+                break  # a process has failed, see its traceback
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    wall = time.time() - wall_before
+    for worker in workers:
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+
+    server.stop()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+    os.chdir(cwd)
+    directory.cleanup()
+    sys.stdin.close()
+    sys.stdin = stdin
+
+    login_times = sorted(t for m in measurements for t in m['login_times'])
+    link_times = sorted(t for m in measurements for t in m['link_times'])
+    latencies = sorted(t for m in measurements for t in m['latencies'])
+    login_span = max(m['login_end'] for m in measurements) - min(m['login_start'] for m in measurements)
+    cpu = usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime
+    result = {
+        'benchmark': 'load',
+        'server': server_class.__name__,
+        'version': PROGRAM_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'players': players,
+        'processes': processes,
+        'rounds': rounds,
+        'logged_in': len(login_times),
+        'logins_per_second': len(login_times) / login_span if login_span else 0.0,
+        'login_p50_ms': 1000 * percentile(login_times, 0.5),
+        'login_p99_ms': 1000 * percentile(login_times, 0.99),
+        'linked': len(link_times),
+        'link_p50_ms': 1000 * percentile(link_times, 0.5),
+        'link_p99_ms': 1000 * percentile(link_times, 0.99),
+        'link_max_ms': 1000 * (link_times[-1] if link_times else 0.0),
+        'relayed': len(latencies),
+        'relay_expected': len(link_times) * rounds,
+        'relay_p50_ms': 1000 * percentile(latencies, 0.5),
+        'relay_p99_ms': 1000 * percentile(latencies, 0.99),
+        'relay_p999_ms': 1000 * percentile(latencies, 0.999),
+        'relay_max_ms': 1000 * (latencies[-1] if latencies else 0.0),
+        'server_cpu_seconds': cpu,
+        'server_cpu_percent': 100 * cpu / wall,
+        'server_rss_before_mb': rss_before,
+        'server_rss_peak_mb': rss_mb(),
+    }
+    with open(output, 'w') as file:
+        json.dump(result, file, indent=2)
+
+    print(f'load - {server_class.__name__} / {players} players from {processes} processes / {rounds} rounds')
+    print(f'logins: {result["logged_in"]} at {result["logins_per_second"]:.0f}/s '
+          f'(p50 {result["login_p50_ms"]:.1f}ms / p99 {result["login_p99_ms"]:.1f}ms)')
+    print(f'time to link: {result["linked"]} players, p50 {result["link_p50_ms"]:.1f}ms / '
+          f'p99 {result["link_p99_ms"]:.1f}ms / max {result["link_max_ms"]:.1f}ms')
+    print(f'relay: {result["relayed"]} of {result["relay_expected"]} moves, p50 {result["relay_p50_ms"]:.2f}ms / '
+          f'p99 {result["relay_p99_ms"]:.2f}ms / p999 {result["relay_p999_ms"]:.2f}ms')
+    print(f'server: cpu {cpu:.1f}s ({result["server_cpu_percent"]:.0f}%) / '
+          f'rss {rss_before:.0f}MB -> peak {result["server_rss_peak_mb"]:.0f}MB')
+    print(f'results written to {output}')
+
+
+if __name__ == '__main__':
+    load_options = {
+        'players': option('--players', 2000),
+        'processes': option('--processes', 4),
+        'rounds': option('--rounds', 20),
+    }
+    benchmarks = {
+        'framing': bench_framing,
+        'memory': bench_memory,
+        'load': lambda: bench_load(Server, **load_options),
+        'load_async': lambda: bench_load(AsyncServer, **load_options),
+    }
+    names = sys.argv[1:] or ['framing']
+    for name in names:
+        if name not in benchmarks:
+            print(f'unknown benchmark {name} - choose from: {", ".join(benchmarks)}')
+            exit(-1)
+        benchmarks[name]()
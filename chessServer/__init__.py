@@ -1,7 +1,12 @@
 from chessServer.admin import Admin
 from chessServer.client import Client
 from chessServer.database import Database
+from chessServer.leaderboard import Leaderboard
+from chessServer.metrics import Metrics
+from chessServer.persistence import Persistence
 from chessServer.server import Server
+from chessServer.async_server import AsyncServer
+from chessServer.cluster import ClusterServer, Supervisor
 from chessServer.shared import get_local_ip
 from chessServer.test import TestServer
 from chessServer.user import User
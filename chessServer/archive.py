@@ -0,0 +1,199 @@
+import logging
+import sqlite3
+import time
+import typing
+from datetime import datetime
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+from chessServer.shared import ETX
+
+# a game and its moves in chunks, one chunk per flush. the frames of a chunk are separated by ETX and start
+# with W or B, the color of the sender
+SCHEMA = ('''CREATE TABLE IF NOT EXISTS GAMES
+             (ID INT PRIMARY KEY NOT NULL,
+             WHITE TEXT NOT NULL,
+             BLACK TEXT NOT NULL,
+             STARTED REAL NOT NULL,
+             ENDED REAL,
+             RESULT TEXT,
+             MOVES INT NOT NULL)''',
+          '''CREATE TABLE IF NOT EXISTS MOVES
+             (GAME INT NOT NULL,
+             SEQ INT NOT NULL,
+             FRAMES TEXT NOT NULL,
+             PRIMARY KEY (GAME, SEQ)) WITHOUT ROWID''',
+          'CREATE INDEX IF NOT EXISTS GAMES_WHITE ON GAMES (WHITE, ID)',
+          'CREATE INDEX IF NOT EXISTS GAMES_BLACK ON GAMES (BLACK, ID)')
+UPSERT = '''INSERT INTO GAMES (ID, WHITE, BLACK, STARTED, ENDED, RESULT, MOVES) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ID) DO UPDATE SET ENDED = excluded.ENDED, RESULT = excluded.RESULT, MOVES = excluded.MOVES'''
+# the games of a player, newest first. each index is read up to the requested page only:
+HISTORY = '''SELECT * FROM (SELECT ID, WHITE, BLACK, STARTED, RESULT, MOVES FROM GAMES WHERE WHITE = ?
+                            ORDER BY ID DESC LIMIT ?)
+             UNION ALL
+             SELECT * FROM (SELECT ID, WHITE, BLACK, STARTED, RESULT, MOVES FROM GAMES WHERE BLACK = ?
+                            ORDER BY ID DESC LIMIT ?)
+             ORDER BY ID DESC LIMIT ? OFFSET ?'''
+
+RESULTS = {1.0: '1:0', 0.0: '0:1', 0.5: '1/2:1/2'}  # scoring of white -> result, * for an aborted game
+
+T_Reply = typing.Callable[[str], None]
+
+
+class Game:
+    # a game in progress. the main loop appends the relayed frames, the archive takes them with the next flush
+    __slots__ = ('id', 'white', 'black', 'started', 'ended', 'result', 'moves', 'count', 'chunks', 'stored')
+
+    def __init__(self, game_id: int, white: str, black: str):
+        self.id = game_id
+        self.white = white
+        self.black = black
+        self.started = time.time()
+        self.ended: typing.Union[float, None] = None
+        self.result: typing.Union[str, None] = None
+        self.moves: typing.List[str] = list()  # not yet flushed
+        self.count = 0  # flushed frames
+        self.chunks = 0
+        self.stored = False  # the row is in the database
+
+    def add(self, from_white: bool, frame: str) -> None:
+        self.moves.append(('W' if from_white else 'B') + frame)
+
+
+class GameArchive(Thread):
+    # owns the game database. games are written in batches, history requests are answered by this thread
+    FLUSH_INTERVAL = 1.0  # seconds
+    PAGE_SIZE = 10  # games per page of %SERVER HISTORY
+    MAX_PAGE = 1000  # deeper pages are refused, every page reads the games up to it
+
+    def __init__(self, filename: str, name: str = 'archive'):
+        super(GameArchive, self).__init__(name=name)
+        self.daemon = True
+        self.__filename = filename
+        self.__lock = Lock()
+        self.__open: typing.Dict[int, Game] = dict()  # game id -> game in progress
+        self.__ended: typing.List[Game] = list()  # not yet flushed
+        self.__requests: Queue = Queue()
+        db = self.__connect()
+        self.__id = (db.execute('SELECT MAX(ID) FROM GAMES').fetchone()[0] or 0) + 1
+        self.__id_step = 1
+        db.close()
+        self.archived = 0
+
+    def __connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.__filename, timeout=10)  # the workers of a cluster share the file
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            db.execute(statement)
+        return db
+
+    def set_id(self, residue: int, step: int) -> None:
+        # the workers of a cluster hand out the ids which leave their own residue modulo step, see User.set_id
+        self.__id += (residue - self.__id) % step
+        self.__id_step = step
+
+    def start_game(self, white: str, black: str) -> Game:
+        game = Game(self.__id, white, black)
+        self.__id += self.__id_step
+        with self.__lock:
+            self.__open[game.id] = game
+        return game
+
+    def end_game(self, game: Game, result: str) -> None:
+        # result: 1:0, 0:1, 1/2:1/2 or * for an aborted game
+        with self.__lock:
+            if self.__open.pop(game.id, None):
+                game.ended = time.time()
+                game.result = result
+                self.__ended.append(game)
+
+    def request_history(self, name: str, page: int, reply: T_Reply) -> None:
+        self.__requests.put((name, page, reply))
+
+    def stop(self) -> None:
+        # the games in progress end as aborted
+        for game in list(self.__open.values()):
+            self.end_game(game, '*')
+        self.__requests.put(None)
+        if self.is_alive():
+            self.join()
+
+    def run(self) -> None:
+        db = self.__connect()
+        next_flush = time.time() + GameArchive.FLUSH_INTERVAL
+        while True:
+            try:
+                request = self.__requests.get(timeout=max(next_flush - time.time(), 0.0))
+            except Empty:
+                request = ()
+            try:
+                if request is None or request or time.time() >= next_flush:
+                    self.__flush(db)  # a history request includes the games which just ended
+                    next_flush = time.time() + GameArchive.FLUSH_INTERVAL
+                if request:
+                    self.__answer(db, *request)
+            except Exception as ex:
+                logging.error(f'ERROR GAME ARCHIVE - {str(ex)}')  # e.g. a bad request, the archive goes on
+            if request is None:
+                break
+        db.close()
+        logging.info(f'{self.name} interrupted')
+
+    def __flush(self, db: sqlite3.Connection) -> None:
+        with self.__lock:
+            games = list(self.__open.values())
+            ended, self.__ended = self.__ended, list()
+        rows, chunks, taken_frames = list(), list(), list()
+        for game in games + ended:
+            taken = len(game.moves)
+            if game.stored and not taken and game.ended is None:
+                continue  # nothing new
+            frames = game.moves[:taken]
+            del game.moves[:taken]  # the main loop only appends, so it keeps the frames beyond
+            taken_frames.append((game, frames))
+            if frames:
+                chunks.append((game.id, game.chunks, ETX.join(frames)))
+                game.chunks += 1
+                game.count += taken
+            rows.append((game.id, game.white, game.black, game.started, game.ended, game.result, game.count))
+            game.stored = True
+        if not rows:
+            return
+        try:
+            with db:
+                db.executemany(UPSERT, rows)
+                db.executemany('INSERT OR REPLACE INTO MOVES (GAME, SEQ, FRAMES) VALUES (?, ?, ?)', chunks)
+            self.archived += len(ended)
+        except sqlite3.Error as ex:
+            logging.error(f'ERROR GAME ARCHIVE - {str(ex)}')
+            for game, frames in taken_frames:  # retried with the next flush
+                game.moves[:0] = frames
+                game.chunks -= 1 if frames else 0
+                game.count -= len(frames)
+                game.stored = False
+            with self.__lock:
+                self.__ended[:0] = ended
+
+    def __answer(self, db: sqlite3.Connection, name: str, page: int, reply: T_Reply) -> None:
+        size = GameArchive.PAGE_SIZE
+        try:
+            games = db.execute(HISTORY, (name, page * size, name, page * size, size, (page - 1) * size)).fetchall()
+        except sqlite3.Error as ex:
+            logging.error(f'ERROR GAME ARCHIVE - {str(ex)}')
+            games = list()
+        out = [f'%HISTORY [ {name} - page {page} ]']
+        for game_id, white, black, started, result, moves in games:
+            date = datetime.fromtimestamp(started).strftime('%d.%m.%Y %H:%M')
+            out.append(f'#{game_id} {white} - {black} {result or "..."} ({date}, {moves} moves)')
+        if not games:
+            out.append('no games' if page == 1 else f'no games on page {page}')
+        elif len(games) == size:
+            out.append(f'next page: %SERVER HISTORY {name} {page + 1}')
+        try:
+            reply('\n'.join(out))
+        except Exception as ex:
+            logging.info(str(ex))
+
+    def get_info(self) -> str:
+        return f'games: {len(self.__open)} in progress / {self.archived} archived'
@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import time
+import typing
+from threading import Thread
+
+from chessServer.database import Database
+from chessServer.framing import ETX_BYTES, decode
+from chessServer.matchmaker import Matchmaker
+from chessServer.server import Server
+from chessServer.shared import *
+from chessServer.user import User
+
+
+class StreamSocket:
+    # socket like wrapper of a StreamWriter so User.notify and Server.sign_off work unchanged
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.__writer = writer
+        self.__loop = loop
+
+    def __in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            return False
+
+    def send(self, data: bytes) -> int:
+        data = bytes(data)  # the caller reuses its buffer
+        if self.__writer.is_closing():
+            raise ConnectionResetError('stream is closed')
+        if self.__writer.transport.get_write_buffer_size() > User.HIGH_WATER_MARK:
+            self.close()  # slow consumer
+            raise ConnectionResetError('client does not receive its messages')
+        if self.__in_loop():
+            self.__writer.write(data)
+        else:
+            self.__loop.call_soon_threadsafe(self.__writer.write, data)
+        return len(data)
+
+    def close(self) -> None:
+        if self.__in_loop():
+            self.__writer.close()
+        else:
+            self.__loop.call_soon_threadsafe(self.__writer.close)
+
+    def settimeout(self, _time_out: float) -> None:
+        pass  # time outs are handled by the event loop
+
+
+class AsyncServer(Server):
+    # runs the admittance, the message processing and the admin commands as coroutines on one event loop
+
+    def __init__(self, hostname: str, port, authentication: str, admin_authentication: str):
+        super(AsyncServer, self).__init__(hostname, port, authentication, admin_authentication)
+        self.__loop: typing.Union[asyncio.AbstractEventLoop, None] = None
+        self.__wake: typing.Union[asyncio.Event, None] = None
+        self.__connections: typing.Set[asyncio.Task] = set()
+
+    def run(self):
+        if not self._bind():
+            return
+
+        self._persistence.start()
+        self._feedback.start()
+        self._archive.start()
+        self._journal.start()
+        self._start_metrics_endpoint()
+        event_loop = Thread(target=asyncio.run, args=(self.__serve(),), name=f'{self.SOCKET_NAME} event loop')
+        event_loop.start()
+        administrator = Thread(target=self._administrate, name=f'{self.SOCKET_NAME} administrator')
+        administrator.daemon = True
+        administrator.start()
+
+    def stop(self) -> None:
+        super(AsyncServer, self).stop()
+        if self.__loop:
+            try:
+                self.__loop.call_soon_threadsafe(self.__wake.set)
+            except RuntimeError:
+                pass  # event loop already closed
+
+    def _post(self, callback: typing.Callable[[], None]) -> None:
+        # runs the callback on the event loop, which owns the server state
+        loop = self.__loop
+        if not loop:
+            callback()  # the event loop is not running yet
+            return
+        try:
+            loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    def _notify(self, user: User, *messages: str) -> None:
+        self._frames_out.inc(len(messages))
+        self._bytes_out.inc(user.notify(*messages))  # the stream writer buffers the output
+
+    async def __serve(self) -> None:
+        self.__loop = asyncio.get_running_loop()
+        self.__wake = asyncio.Event()
+        self._load_users_or_stop()
+        self._server_socket.setblocking(False)
+        server = await asyncio.start_server(self.__handle_connection, sock=self._server_socket,
+                                            backlog=Server.BACKLOG)
+        last_link = 0.0
+        last_db_update = time.time()
+
+        while not self._stop:
+            wait_timeout = Server.SELECT_TIMEOUT
+            if len(self._users_to_link) > 1:
+                wait_timeout = min(wait_timeout, max(0.0, last_link + Matchmaker.MATCH_INTERVAL - time.time()))
+            try:
+                await asyncio.wait_for(self.__wake.wait(), wait_timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.__wake.clear()
+            t0 = time.time()
+
+            self._remove_disconnected_users()
+            self._reap_idle_users(t0)
+
+            if len(self._users_to_link) > 1 and time.time() - last_link > Matchmaker.MATCH_INTERVAL:
+                self._link_waiting_users()
+                last_link = time.time()
+
+            if time.time() - last_db_update > Server.DB_UPDATE_INTERVAL:
+                logging.info(self.execute('update'))  # queue database update
+                last_db_update = time.time()
+            self._cycle_seconds.observe(time.time() - t0)
+
+        server.close()
+        for user in list(self._online_users):
+            self.sign_off(user)
+        if self._admin:
+            self._admin.socket.close()
+        for connection in self.__connections:
+            connection.cancel()
+        await asyncio.gather(*self.__connections, return_exceptions=True)
+        await server.wait_closed()
+        logging.info(self.SOCKET_NAME + ' event loop interrupted')
+        self._admin_worker.shutdown()
+        self._stop_metrics_endpoint()
+        if self._users_loaded:
+            logging.info(self.execute('update'))  # database update
+        self._persistence.stop()
+        self._persistence.join()  # the journal is truncated once the update is written
+        self._journal.stop()
+        self._feedback.stop()
+        self._archive.stop()
+        if self._reader:
+            self._read(Database.close)
+        self.__loop = None
+
+    @staticmethod
+    async def __next_frame(reader: asyncio.StreamReader, time_out: typing.Union[float, None] = None) -> bytes:
+        # returns a message including its ETX
+        try:
+            return await asyncio.wait_for(reader.readuntil(ETX_BYTES), time_out)
+        except asyncio.IncompleteReadError:
+            raise ConnectionAbortedError('connection closed by peer')
+        except asyncio.LimitOverrunError:
+            raise ConnectionAbortedError('message too long')
+
+    @staticmethod
+    async def __next_message(reader: asyncio.StreamReader, time_out: typing.Union[float, None] = None) -> str:
+        data = await AsyncServer.__next_frame(reader, time_out)
+        return decode(data[:-len(ETX_BYTES)])
+
+    @staticmethod
+    async def __reject(user: User, reader: asyncio.StreamReader, message: str) -> None:
+        # same as User.error: inform the client, wait for the echo and close the connection
+        try:
+            user.notify('%INFO ' + message)
+            user.notify('%ECHO?')
+            print(await AsyncServer.__next_message(reader, 1))
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        user.socket.close()
+        print(message + '\n' + 'socket id_' + str(user.get_id()) + ' closed')
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = asyncio.current_task()
+        self.__connections.add(connection)
+        try:
+            await self.__connect(reader, writer)
+        except asyncio.CancelledError:
+            writer.close()  # server stopped
+        finally:
+            self.__connections.discard(connection)
+
+    async def __connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        _address = writer.get_extra_info('peername')
+        ip = _address[0]
+        if self._over_accept_limit(ip):
+            self._reset_on_close(writer.get_extra_info('socket'))
+            writer.transport.abort()
+            return
+        logging.info(f'connected to {str(_address)}')
+
+        new_user = User(StreamSocket(writer, self.__loop), ip)
+        accepted = time.time()
+        deadline = accepted + Server.HANDSHAKE_TIMEOUT
+
+        def remaining() -> float:
+            return max(deadline - time.time(), 0.0)
+
+        async def next_message() -> str:
+            # the frames of the admittance are counted like the frames of the online users
+            data = await self.__next_frame(reader, remaining())
+            self._bytes_in.inc(len(data))
+            self._frames_in.inc()
+            return decode(data[:-len(ETX_BYTES)])
+
+        try:
+            authentication = await next_message()
+
+            if self._is_admin(authentication):
+                self._set_admin(new_user)
+                await self.__serve_admin(new_user, reader)
+                return
+
+            if not self._is_authenticated(authentication):
+                await self.__reject(new_user, reader, string(AUTH_ERROR))
+                return
+
+            user_name = self._parse_name(await next_message())
+            if not user_name:
+                await self.__reject(new_user, reader, string(PROTOCOL_ERROR))
+                return
+
+            user_password = await next_message()
+            stored = None
+            if user_name not in self._users_by_name:
+                # the database is read off the event loop, so the other users do not wait for it
+                stored = await self.__loop.run_in_executor(None, self._read, lambda db: db.get_user(user_name))
+            # a user loaded meanwhile takes precedence, see _cache_user:
+            admitted_user, error = self._admit(new_user, user_name, user_password, self._cache_user(user_name, stored))
+            if not admitted_user:
+                await self.__reject(new_user, reader, error)
+                return
+            new_user = admitted_user
+            new_user.notify('WELCOME ' + user_name)
+
+        except asyncio.TimeoutError:
+            logging.info('TIMEOUT ERROR (ADMITTANCE)')
+            await self.__reject(new_user, reader, string(TIMEOUT_ERROR))
+            return
+        except ConnectionError:
+            logging.info('CONNECTION ERROR (ADMITTANCE)')
+            writer.close()
+            return
+        except Exception as ex:
+            logging.error(str(ex))
+            writer.close()
+            return
+
+        self._handshake_seconds.observe(time.time() - accepted)
+        logging.info(f'{user_name} has connected')
+        self.register_user(new_user)
+        await self.__serve_user(new_user, reader)
+
+    async def __serve_user(self, user: User, reader: asyncio.StreamReader) -> None:
+        connection = user.socket
+        while user in self._online_users and user.socket is connection:
+            try:
+                data = await self.__next_frame(reader)
+                user.last_received = time.time()
+                self._bytes_in.inc(len(data))
+                self._frames_in.inc()
+                msg = decode(data[:-len(ETX_BYTES)])
+            except ConnectionError:
+                logging.info('CONNECTION ERROR (RECEIVING DATA FROM ' + user.get_name() + ')')
+                break
+            except OSError as ex:
+                logging.info('ERROR (RECEIVING DATA FROM ' + user.get_name() + ')')
+                logging.error(str(ex))
+                break
+            if not msg:
+                continue
+            logging.debug(f'{user.get_name()}:{msg}')
+            try:
+                self._process_message(user, msg)
+            except Exception as ex:
+                logging.error(str(ex))
+            self._remove_disconnected_users()
+
+        if user in self._online_users and user.socket is connection:
+            self._disconnected_users.add(user)
+            self._remove_disconnected_users()
+        connection.close()
+
+    async def __serve_admin(self, admin: User, reader: asyncio.StreamReader) -> None:
+        while admin is self._admin:
+            try:
+                cmd = await self.__next_message(reader)
+            except OSError as ex:
+                logging.info('ERROR (RECEIVING DATA FROM ADMIN)')
+                logging.info(str(ex))
+                break
+            if not cmd:
+                continue
+            # the reply comes back to the event loop, also from the admin worker:
+            self._admin_command(cmd, lambda output: self._post(lambda: self.__reply_admin(admin, output)))
+
+        if admin is self._admin:
+            self._admin = None
+        admin.socket.close()
+
+    def __reply_admin(self, admin: User, output: str) -> None:
+        if admin is not self._admin:
+            return  # signed off or replaced meanwhile
+        try:
+            admin.notify(output)
+        except ConnectionError:
+            logging.info('CONNECTION ERROR (NOTIFY ADMIN)')
+            self._admin = None
+            admin.socket.close()  # ends __serve_admin
@@ -4,7 +4,8 @@ from socket import socket as sock
 from socket import timeout
 from threading import Thread
 
-from chessServer.shared import BUFFER_SIZE, ETX
+from chessServer.framing import FrameBuffer
+from chessServer.shared import ETX
 
 
 class Client:
@@ -14,7 +15,7 @@ class Client:
         self.authentication = authentication
         self.socket = sock()
         self.name = name
-        self.__data = str()
+        self.__buffer = FrameBuffer()
 
         try:
             self.socket.connect((hostname, self.port))
@@ -62,28 +63,16 @@ class Client:
         self.socket.send((text + ETX).encode('utf-8'))
 
     def next_message(self) -> str:
-        msg = self.__next_message()
+        msg = self.__buffer.next_message()
         if not msg:
-            self.__data += self._recv()
-            msg = self.__next_message()
-            if self.__data and not msg:
+            self._recv()
+            msg = self.__buffer.next_message()
+            if len(self.__buffer) and not msg:
                 return '%INCOMPLETE'
             else:
-                return msg
+                return msg or ''
         return msg
 
-    def __next_message(self) -> str:
-        count = self.__data.count(ETX)
-        if count == 0:
-            return ''
-        split = self.__data.split(ETX, 1)
-        if len(split) == 2:
-            self.__data = split[1]
-            return split[0]
-        elif len(split) == 1:
-            self.__data = ''
-            return split[0]
-
     def __sender(self):
         while True:
             try:
@@ -105,8 +94,8 @@ class Client:
                 logging.info(str(ex))
                 return
 
-    def _recv(self) -> str:
-        return self.socket.recv(BUFFER_SIZE).decode()
+    def _recv(self) -> int:
+        return self.__buffer.receive(self.socket)
 
     def __receiver(self):
         while True:
@@ -116,6 +105,8 @@ class Client:
                     logging.info('nothing to receive')
                     self.socket.close()
                     return
+                elif msg == '%ECHO?':
+                    self.send('%ECHO')  # heartbeat of the server
                 elif msg != '%INCOMPLETE':
                     print(msg)
             except timeout:
@@ -0,0 +1,532 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import typing
+from multiprocessing.connection import Connection, wait
+from random import randint
+from pathlib import Path
+from threading import Thread
+
+from chessServer.database import Database
+from chessServer.journal import RatingJournal
+from chessServer.matchmaker import Matchmaker
+from chessServer.server import Server
+from chessServer.shared import *
+from chessServer.user import User
+
+
+class Player(typing.NamedTuple):
+    # a user as seen by the other processes of the cluster
+    worker: int
+    name: str
+    user_id: int
+    rating: int
+    elo_weight: int
+
+
+class RemotePeer:
+    # stands in for the opponent of a local user who is connected to another worker
+
+    def __init__(self, player: Player, server: 'ClusterServer'):
+        self.player = player
+        self.rating = player.rating
+        self.__server = server
+
+    def __eq__(self, other):
+        return self.get_id() == other.get_id()
+
+    def __hash__(self):
+        return self.player.user_id
+
+    def __str__(self):
+        return f'ID_{self.player.user_id} {self.player.name} ELO:{self.rating} (worker {self.player.worker})'
+
+    def get_name(self) -> str:
+        return self.player.name
+
+    def get_id(self) -> int:
+        return self.player.user_id
+
+    def get_elo_weight(self) -> int:
+        return self.player.elo_weight
+
+    def notify(self, *messages: str) -> None:
+        self.__server.send_to(self.player.worker, ('relay', self.player.name, messages))
+
+    def add_result(self, rating: int, scoring: float) -> None:
+        # the worker of the user updates the user, see ClusterServer.__handle
+        self.rating = rating
+        self.__server.send_to(self.player.worker, ('result', self.player.name, rating, scoring))
+
+
+class ClusterServer(Server):
+    # one worker process of a cluster. the workers accept connections on the same port (SO_REUSEPORT) and share
+    # the database. the supervisor matches the waiting users of all workers and routes the messages of players
+    # who are linked across workers
+
+    def __init__(self, hostname: str, port, authentication: str, admin_authentication: str,
+                 channel: Connection, worker: int, workers: int):
+        super(ClusterServer, self).__init__(hostname, port, authentication, admin_authentication)
+        self.__channel = channel
+        self.__channel_lock = threading.Lock()
+        self.__worker = worker
+        self.__workers = workers
+        self.__kicked: typing.Set[User] = set()  # users who signed in on another worker first
+        self.__registered_on_load = 0  # users in the database when the worker started, see Supervisor.counts
+        self._journal = RatingJournal(self.DATA_DIR, f'journal-w{worker}', f'worker {worker} journal')
+
+    def run(self):
+        listener = Thread(target=self.__listen, name=f'worker {self.__worker} channel')
+        listener.daemon = True
+        listener.start()
+        super(ClusterServer, self).run()
+
+    def _bind(self) -> bool:
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return super(ClusterServer, self)._bind()
+
+    def _administrate(self):
+        pass  # the supervisor reads the commands and sends them to every worker
+
+    def _load_users(self) -> None:
+        super(ClusterServer, self)._load_users()
+        # the ids of worker n leave the residue n modulo the number of workers, so they never collide. the journals
+        # were replayed by the supervisor, every id above the highest one read here is new:
+        next_id = User._id
+        User.set_id(next_id + (self.__worker - next_id) % self.__workers, self.__workers)
+        self._archive.set_id(self.__worker, self.__workers)
+        self.__registered_on_load = self._registered_users
+
+    def _journal_names(self, names: typing.List[str]) -> typing.List[str]:
+        return list()  # replayed by the supervisor before the workers start, see Supervisor.replay_journals
+
+    def register_user(self, user: User) -> None:
+        super(ClusterServer, self).register_user(user)
+        self.__send(('online', user.get_name()))
+
+    def send_to(self, worker: int, message: tuple) -> None:
+        self.__send(('route', worker, message))
+
+    def __send(self, message: tuple) -> None:
+        with self.__channel_lock:
+            try:
+                self.__channel.send(message)
+            except (OSError, ValueError) as ex:
+                logging.error(f'worker {self.__worker} channel - {str(ex)}')
+
+    def _notify(self, user: User, *messages: str) -> None:
+        if isinstance(user, RemotePeer):
+            user.notify(*messages)  # the worker of the peer queues the messages
+        else:
+            super(ClusterServer, self)._notify(user, *messages)
+
+    def __player(self, user: User) -> Player:
+        return Player(self.__worker, user.get_name(), user.get_id(), user.rating, user.get_elo_weight())
+
+    def __listen(self) -> None:
+        while True:
+            try:
+                message = self.__channel.recv()
+            except (EOFError, OSError):
+                logging.info(f'worker {self.__worker} channel closed')
+                self.stop()
+                return
+            self._post(lambda m=message: self.__handle(m))
+
+    def _request_link(self, user: User) -> None:
+        self.__send(('wait', self.__player(user)))
+
+    def _request_link_to(self, user_a: User, name: str) -> None:
+        if self._get_online_user_by_name(name):
+            super(ClusterServer, self)._request_link_to(user_a, name)
+        else:
+            self.__send(('link_to', self.__player(user_a), name))
+
+    def _link_users(self, user_a: User, user_b: User) -> None:
+        super(ClusterServer, self)._link_users(user_a, user_b)
+        self.__send(('unwait', user_a.get_name()))
+        self.__send(('unwait', user_b.get_name()))
+
+    def _rating_changed(self, user: User) -> None:
+        if isinstance(user, RemotePeer):
+            # the worker of the peer journals the row and broadcasts the rating
+            self._leaderboard.update(user.get_id(), user.get_name(), user.rating)
+            return
+        super(ClusterServer, self)._rating_changed(user)
+        self.__send(('broadcast', ('rating', user.get_id(), user.get_name(), user.rating)))
+
+    def _on_user_offline(self, user: User) -> None:
+        partner = self._linked_users.get(user)
+        if isinstance(partner, RemotePeer):
+            self.send_to(partner.player.worker, ('unlink', partner.get_name()))
+        if user in self.__kicked:
+            self.__send(('offline', user.get_name()))
+            self.__kicked.discard(user)
+            user.dirty = False  # the login was refused, keep the row of the other worker
+            self._post(lambda: self.__drop_kicked(user))
+            return
+        # the supervisor refuses the user on the other workers until the row is written:
+        self.__write_back(user.get_name(), ('offline', user.get_name()))
+
+    def __write_back(self, name: str, *messages: tuple) -> None:
+        # writes the row of the user if it changed and then sends the messages and lets the other workers drop
+        # their copies of the user. the database updates are written in order, so the messages follow the updates
+        # which were queued before, e.g. the removal of the user
+        user = self._users_by_name.get(name)
+        rows = list()
+        if user and user.dirty:
+            user.dirty = False
+            rows.append(user.to_row())
+
+        def saved():
+            for message in messages + (('broadcast', ('evict', name)),):
+                self.__send(message)
+
+        def failed():
+            if user:
+                user.dirty = True
+            for message in messages:
+                self.__send(message)  # the user is not locked out, the row is written with the next update
+
+        self._persistence.update_users(rows, [], failed, saved)
+
+    def __drop_kicked(self, user: User) -> None:
+        stored = self._read(lambda db: db.get_user(user.get_name()))
+        if not stored or stored.get_id() != user.get_id():
+            self._registered_users -= 1  # was counted as a new user
+        self._forget_user(user.get_name())
+
+    def __link_remote(self, user: User, peer: RemotePeer, color: str) -> None:
+        if user in self._users_to_link:
+            self._users_to_link.remove(user)
+        self.__send(('unwait', user.get_name()))
+        self._linked_users.update({user: peer, peer: user})
+        if color == PLAY_WHITE:
+            self._start_game(user, peer)  # the worker of white archives the game
+        self._notify(user, '%NAME ' + peer.get_name(),
+                     '%NOTE ' + string(CONNECTED_WITH).format(peer.get_name(), peer.rating),
+                     NEW_GAME, color)
+
+    def __handle(self, message: tuple) -> None:
+        # runs on the main loop
+        kind, args = message[0], message[1:]
+
+        def kick(name: str):
+            user = self._get_online_user_by_name(name)
+            if user:
+                try:
+                    user.notify('%INFO ' + string(ALREADY_ASSIGNED).format(name))
+                except OSError:
+                    pass
+                skt = user.socket
+                self.__kicked.add(user)
+                self._disconnected_users.add(user)
+                self._remove_disconnected_users()
+                skt.close()  # after it is unselected
+
+        def owned(name: str):
+            # the supervisor has granted the user to this worker. the worker which had the user before signed it
+            # off once its row was written, see _on_user_offline. the row read by the login or the copy cached here
+            # may be older, then the row has more games and the user takes it
+            user = self._get_online_user_by_name(name)
+            if not user or self._persistence.is_pending(user.get_id()):
+                return  # the copy of this worker is the newest
+            stored = self._read(lambda db: db.get_user(name))
+            if stored and stored.get_id() == user.get_id() and stored.played_games > user.played_games:
+                user.take_row(stored)
+
+        def link(name_a: str, name_b: str):
+            # both users are connected to this worker
+            user_a = self._get_online_user_by_name(name_a)
+            user_b = self._get_online_user_by_name(name_b)
+            if user_a and user_b and user_a not in self._linked_users and user_b not in self._linked_users:
+                self._link_users(user_a, user_b)
+                return
+            for user in (user_a, user_b):
+                if user in self._users_to_link:
+                    self._request_link(user)  # the opponent has left, wait for another one
+
+        def pair(name: str, player: Player, color: str):
+            user = self._get_online_user_by_name(name)
+            if not user or user in self._linked_users:
+                self.send_to(player.worker, ('unlink', player.name))
+                return
+            self.__link_remote(user, RemotePeer(player, self), color)
+
+        def link_to(requester: Player, name: str):
+            user = self._get_online_user_by_name(name)
+            if user and user not in self._linked_users:
+                colors = (PLAY_WHITE, PLAY_BLACK) if randint(0, 1) else (PLAY_BLACK, PLAY_WHITE)
+                self.__link_remote(user, RemotePeer(requester, self), colors[0])
+                self.send_to(requester.worker, ('pair', requester.name, self.__player(user), colors[1]))
+
+        def relay(name: str, messages: tuple):
+            user = self._get_online_user_by_name(name)
+            if user:
+                game = self._games.get(user)
+                if game:
+                    for msg in messages:
+                        game.add(game.white != name, msg)
+                self._notify(user, *messages)
+
+        def result(name: str, rating: int, scoring: float):
+            user = self._get_user_by_name(name)
+            if user:
+                user.add_result(rating, scoring)
+                self._rating_changed(user)
+                if user in self._linked_users:
+                    self._end_game(user, self._linked_users[user], scoring)
+                unlink(name)
+
+        def unlink(name: str):
+            user = self._get_online_user_by_name(name)
+            partner = self._linked_users.get(user)
+            if isinstance(partner, RemotePeer):
+                self._end_game(user, partner)
+                self._linked_users.pop(user)
+                self._linked_users.pop(partner)
+
+        def update_rating(user_id: int, name: str, rating: int):
+            self._leaderboard.update(user_id, name, rating)
+
+        def execute(command: str):
+            arguments = command.split()
+            replies = [('counts', self.__registered_on_load, self._registered_users, len(self._online_users))] \
+                if arguments[:1] == ['info'] else []
+
+            def reply(output: str):
+                for message in [('output', output)] + replies:
+                    self.__send(message)
+
+            self._admin_command(command, reply)
+            if len(arguments) > 1 and arguments[0] in Supervisor.USER_COMMANDS and \
+                    not self._get_online_user_by_name(arguments[1]):
+                self.__write_back(arguments[1])  # e.g. the reset password of an offline user
+
+        handlers = {
+            'kick': kick,
+            'owned': owned,
+            'link': link,
+            'pair': pair,
+            'link_to': link_to,
+            'relay': relay,
+            'result': result,
+            'unlink': unlink,
+            'rating': update_rating,
+            'evict': self._forget_user,
+            'execute': execute,
+        }
+        handlers[kind](*args)
+
+
+def run_worker(channel: Connection, worker: int, workers: int, metrics_port: typing.Union[int, None], hostname: str,
+               port, authentication: str, admin_authentication: str) -> None:
+    logging.basicConfig(level=logging.INFO)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops the workers
+    if metrics_port is not None:
+        Server.METRICS_PORT = metrics_port + worker  # one endpoint per worker
+    server = ClusterServer(hostname, port, authentication, admin_authentication, channel, worker, workers)
+    server.run()
+    # the process ends with this function, so wait for the threads of the server:
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+
+class Supervisor:
+    # starts the worker processes, matches their waiting users and routes the messages between them
+    # admin commands which change the row of a user run on the worker of the user only, on worker 0 if the user
+    # is offline. otherwise every worker would keep a changed copy of the user and write it:
+    USER_COMMANDS = ('remove', 'resetpw')
+
+    def __init__(self, hostname: str, port, authentication: str, admin_authentication: str, workers: int):
+        self.__arguments = (hostname, port, authentication, admin_authentication)
+        self.__workers = workers
+        self.__connections: typing.Dict[int, Connection] = dict()
+        self.__lock = threading.Lock()
+        self.__online: typing.Dict[str, int] = dict()  # user name -> worker
+        self.__counts: typing.Dict[int, typing.Tuple[int, int, int]] = dict()  # worker -> user counts, see info
+        self.__waiting: typing.Dict[str, Player] = dict()  # users waiting for an opponent
+        self.__matchmaker = Matchmaker(Server.LINK_INTERVAL)
+
+    def run(self) -> None:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            logging.error('SO_REUSEPORT is not supported on this platform - run a single server instead')
+            return
+
+        self.replay_journals()
+        # spawned processes inherit no other file descriptors, so a worker notices when the supervisor stops:
+        context = multiprocessing.get_context('spawn')
+        processes = list()
+        for worker in range(self.__workers):
+            connection, channel = context.Pipe()
+            process = context.Process(target=run_worker, name=f'worker {worker}',
+                                      args=(channel, worker, self.__workers, Server.METRICS_PORT) + self.__arguments)
+            process.start()
+            channel.close()
+            self.__connections[worker] = connection
+            processes.append(process)
+
+        console = Thread(target=self.__administrate, name='supervisor console')
+        console.daemon = True
+        console.start()
+        self.__route_messages()
+        for process in processes:
+            process.join()
+        logging.info('supervisor interrupted')
+
+    def replay_journals(self) -> None:
+        # the results journaled by the workers of the last run, e.g. before a crash, are written to the database
+        # before the workers start. so the highest id which the workers read is the same for all of them
+        hostname, port = self.__arguments[:2]
+        data_dir = f'{Path(".").absolute()}/{Server.get_sub_dir_name(hostname, port)}'
+        segments = RatingJournal.get_segments(data_dir) if os.path.isdir(data_dir) else dict()
+        if not segments:
+            return
+        db = Database(f'{data_dir}/users.db')
+        replayed = RatingJournal(data_dir).replay(db.apply_journal, list(segments))
+        db.close()
+        logging.info(f'replayed the journaled results of {replayed} users')
+
+    def __administrate(self) -> None:
+        while True:
+            try:
+                command = input()
+            except EOFError:
+                return
+            arguments = command.split()
+            if command == 'shutdown':
+                workers = [0]
+            elif len(arguments) > 1 and arguments[0] in Supervisor.USER_COMMANDS:
+                workers = [self.__online.get(arguments[1], 0)]
+            else:
+                workers = list(self.__connections)
+            for worker in workers:
+                self.__send(worker, ('execute', command))
+            if command == 'stop':
+                return  # a console thread still reading stdin at the exit of the interpreter aborts it
+
+    def __send(self, worker: int, message: tuple) -> None:
+        connection = self.__connections.get(worker)
+        if not connection:
+            return
+        with self.__lock:
+            try:
+                connection.send(message)
+            except OSError as ex:
+                logging.error(f'could not send to worker {worker} - {str(ex)}')
+
+    def __route_messages(self) -> None:
+        workers = {connection: worker for worker, connection in self.__connections.items()}
+        last_match = time.time()
+        while workers:
+            try:
+                ready = wait(list(workers), timeout=Matchmaker.MATCH_INTERVAL)
+            except KeyboardInterrupt:
+                for worker in list(self.__connections):
+                    self.__send(worker, ('execute', 'stop'))
+                continue
+            for connection in ready:
+                worker = workers[connection]
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    logging.info(f'worker {worker} stopped')
+                    workers.pop(connection)
+                    self.__connections.pop(worker, None)
+                    for name in [name for name, owner in self.__online.items() if owner == worker]:
+                        self.__set_offline(worker, name)
+                    continue
+                try:
+                    self.__handle(worker, message)
+                except Exception as ex:
+                    logging.error(f'supervisor - {str(ex)}')
+
+            if time.time() - last_match > Matchmaker.MATCH_INTERVAL:
+                for player_a, player_b in self.__matchmaker.match(time.time()):
+                    self.__pair(player_a, player_b)
+                last_match = time.time()
+
+    def __pair(self, player_a: Player, player_b: Player) -> None:
+        self.__waiting.pop(player_a.name, None)
+        self.__waiting.pop(player_b.name, None)
+        if player_a.worker == player_b.worker:
+            self.__send(player_a.worker, ('link', player_a.name, player_b.name))
+            return
+        colors = (PLAY_WHITE, PLAY_BLACK) if randint(0, 1) else (PLAY_BLACK, PLAY_WHITE)
+        self.__send(player_a.worker, ('pair', player_a.name, player_b, colors[0]))
+        self.__send(player_b.worker, ('pair', player_b.name, player_a, colors[1]))
+
+    def __unwait(self, name: str) -> None:
+        player = self.__waiting.pop(name, None)
+        if player:
+            self.__matchmaker.remove(player)
+
+    def __set_offline(self, worker: int, name: str) -> None:
+        if self.__online.get(name) == worker:
+            self.__online.pop(name)
+        self.__unwait(name)
+
+    def __handle(self, worker: int, message: tuple) -> None:
+        kind, args = message[0], message[1:]
+
+        def online(name: str):
+            owner = self.__online.get(name)
+            if owner is not None and owner != worker:
+                self.__send(worker, ('kick', name))  # signed in on two workers at the same time
+            else:
+                self.__online[name] = worker
+                self.__send(worker, ('owned', name))
+
+        def wait_for_opponent(player: Player):
+            self.__unwait(player.name)
+            opponent = self.__matchmaker.add(player, time.time())
+            if opponent:
+                self.__pair(player, opponent)
+            else:
+                self.__waiting[player.name] = player
+
+        def link_to(player: Player, name: str):
+            owner = self.__online.get(name)
+            if owner is not None:
+                self.__send(owner, ('link_to', player, name))
+
+        def route(target: int, payload: tuple):
+            self.__send(target, payload)
+
+        def broadcast(payload: tuple):
+            for other in list(self.__connections):
+                if other != worker:
+                    self.__send(other, payload)
+
+        def output(text: str):
+            print(f'worker {worker}:\n{text}')
+
+        def counts(registered_on_load: int, registered: int, online: int):
+            # the workers count the users in the database when they started and the users they registered since
+            self.__counts[worker] = (registered_on_load, registered, online)
+            if len(self.__counts) < len(self.__connections):
+                return
+            values = self.__counts.values()
+            total = min(on_load for on_load, _, _ in values) + sum(count - on_load for on_load, count, _ in values)
+            total_online = sum(count for _, _, count in values)
+            print(f'cluster:\nregistered users: {total}\n'
+                  f'online: {total_online} / offline: {max(total - total_online, 0)}')
+            self.__counts.clear()
+
+        handlers = {
+            'online': online,
+            'offline': lambda name: self.__set_offline(worker, name),
+            'wait': wait_for_opponent,
+            'unwait': self.__unwait,
+            'link_to': link_to,
+            'route': route,
+            'broadcast': broadcast,
+            'output': output,
+            'counts': counts,
+        }
+        handlers[kind](*args)
@@ -1,14 +1,29 @@
 import logging
 import sqlite3
+import typing
 
 from chessServer.user import User
 
 
+COLUMNS = 'ID, IP, NAME, PW, GAMES, ZERO, HALF, ONE, RATING, WEIGHT, LASTLOGIN'
+UPSERT = f'''INSERT INTO USERS ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+             ON CONFLICT(ID) DO UPDATE SET IP = excluded.IP, NAME = excluded.NAME, PW = excluded.PW,
+             GAMES = excluded.GAMES, ZERO = excluded.ZERO, HALF = excluded.HALF, ONE = excluded.ONE,
+             RATING = excluded.RATING, WEIGHT = excluded.WEIGHT, LASTLOGIN = excluded.LASTLOGIN'''
+# a journal row does not replace a row which already holds later games, e.g. written by another worker:
+REPLAY = UPSERT + ' WHERE excluded.GAMES >= USERS.GAMES'
+# errors of one bad row, e.g. a rating out of the range of sqlite. the other rows can still be written:
+ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, OverflowError, ValueError, TypeError)
+
+
 class Database:  # simple wrapper class for sqlite3
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, check_same_thread: bool = True):
         try:
-            self.conn = sqlite3.connect(filename)
+            self.conn = sqlite3.connect(filename, check_same_thread=check_same_thread)
             logging.info('opened database ' + filename)
+            # write ahead log: readers are not blocked by an update, a crash does not corrupt the table
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
             self.conn.execute('''CREATE TABLE USERS
                                 (ID INT PRIMARY KEY NOT NULL,
                                 IP TEXT,
@@ -25,6 +40,12 @@ class Database:  # simple wrapper class for sqlite3
             logging.info('table created')
         except sqlite3.OperationalError as ex:
             logging.info(str(ex))
+        try:
+            # users are loaded on demand by name:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS USERS_NAME ON USERS (NAME)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS USERS_RATING ON USERS (RATING)')
+        except sqlite3.OperationalError as ex:
+            logging.info(str(ex))
 
     def close(self):
         self.conn.close()
@@ -36,29 +57,53 @@ class Database:  # simple wrapper class for sqlite3
         self.conn.commit()
         self.conn.close()
 
-    def get_users(self) -> tuple:
-        users = set()
-        max_id = 0
-        sql_cmd = 'SELECT ID, IP, NAME, PW, GAMES, ZERO, HALF, ONE, RATING, WEIGHT, LASTLOGIN from USERS'
-        cursor = self.conn.execute(sql_cmd)
-        for attributes in cursor:
-            max_id = max(max_id, attributes[0])
-            users.add(User.create_user(attributes))
-        return users, max_id
+    def get_user(self, name: str) -> typing.Union[User, None]:
+        attributes = self.conn.execute(f'SELECT {COLUMNS} from USERS WHERE NAME = ?', (name,)).fetchone()
+        if attributes:
+            return User.create_user(attributes)
+        return None
+
+    def get_page(self, offset: int, limit: int) -> typing.List[User]:
+        cursor = self.conn.execute(f'SELECT {COLUMNS} from USERS ORDER BY ID LIMIT ? OFFSET ?', (limit, offset))
+        return [User.create_user(attributes) for attributes in cursor]
+
+    def get_ratings(self) -> typing.List[typing.Tuple[int, str, int]]:
+        # (ID, NAME, RATING) of all users who played
+        return self.conn.execute('SELECT ID, NAME, RATING from USERS WHERE GAMES > 0').fetchall()
+
+    def get_max_id(self) -> int:
+        return self.conn.execute('SELECT MAX(ID) from USERS').fetchone()[0] or 0
+
+    def count(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) from USERS').fetchone()[0]
 
     def insert(self, users: set) -> None:
-        for user in users:
-            self._insert(user)
+        self.update([user.to_row() for user in users], [])
 
-    def _insert(self, user: User):
-        def t(x):  # sql TEXT
-            return '\"' + str(x) + '\"'
+    def update(self, rows: list, removed_ids: list) -> list:
+        # writes changed rows (see User.to_row) and deletes removed users in one transaction. returns the rows
+        # which could not be written
+        return self.__write(UPSERT, rows, removed_ids)
 
+    def __write(self, statement: str, rows: list, removed_ids: list) -> list:
         try:
-            sql_cmd = f'''INSERT INTO USERS (ID, IP, NAME, PW, GAMES, ZERO, HALF, ONE, RATING, WEIGHT, LASTLOGIN) VALUES(
-                {user.get_id()},{t(user.ip)},{t(user.get_name())},{t(user.get_password())},
-                {user.played_games},{user.scoring_zero},{user.scoring_half},{user.scoring_one},
-                {user.rating},{user.get_elo_weight()},{t(user.last_login)})'''
-            self.conn.execute(sql_cmd)
-        except Exception as ex:
-            logging.info(str(ex))
+            with self.conn:
+                self.conn.executemany(statement, rows)
+                self.conn.executemany('DELETE FROM USERS WHERE ID = ?', [(_id,) for _id in removed_ids])
+            return list()
+        except ROW_ERRORS:
+            pass
+        # a bad row fails the whole batch, so the rows are written one by one and the bad ones are left out:
+        bad_rows = list()
+        with self.conn:
+            for row in rows:
+                try:
+                    self.conn.execute(statement, row)
+                except ROW_ERRORS:
+                    bad_rows.append(row)
+            self.conn.executemany('DELETE FROM USERS WHERE ID = ?', [(_id,) for _id in removed_ids])
+        return bad_rows
+
+    def apply_journal(self, rows: list, removed_ids: list) -> list:
+        # see RatingJournal.replay. returns the rows which could not be written
+        return self.__write(REPLAY, rows, removed_ids)
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import time
+import typing
+from collections import deque
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+T_Entry = typing.Tuple[float, str, str]  # seconds since the epoch, user name, text
+
+
+class FeedbackStore(Thread):
+    # collects the feedback of the users and appends it in batches to one file, one json object per line.
+    # the main loop only appends to a list, the file is written by this thread
+    FLUSH_INTERVAL = 1.0  # seconds
+    MAX_PENDING = 10000  # feedback beyond is dropped until the next flush, e.g. a client which spams
+    MAX_LENGTH = 4000  # characters of one feedback, the rest is cut
+    LEGACY_PREFIX = 'feedback-'  # one file per feedback of earlier versions: feedback-dMM-DDtHH-MM-SS-<user>.txt
+    LEGACY_DATE_LENGTH = 16  # 'dMM-DDtHH-MM-SS-'
+
+    def __init__(self, filename: str, name: str = 'feedback'):
+        super(FeedbackStore, self).__init__(name=name)
+        self.daemon = True
+        self.__filename = filename
+        self.__pending: typing.List[T_Entry] = list()
+        self.__lock = Lock()
+        self.__stopped = Event()
+        self.stored = 0
+        self.dropped = 0
+
+    def add(self, user_name: str, text: str) -> bool:
+        with self.__lock:
+            if len(self.__pending) >= FeedbackStore.MAX_PENDING:
+                self.dropped += 1
+                return False
+            self.__pending.append((time.time(), user_name, text[:FeedbackStore.MAX_LENGTH]))
+            return True
+
+    def run(self) -> None:
+        while not self.__stopped.wait(FeedbackStore.FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+        logging.info(f'{self.name} interrupted')
+
+    def stop(self) -> None:
+        # pending feedback is written before the thread ends
+        self.__stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def flush(self) -> None:
+        with self.__lock:
+            batch, self.__pending = self.__pending, list()
+        if not batch:
+            return
+        data = ''.join(json.dumps({'time': t, 'user': user_name, 'text': text}) + '\n'
+                       for t, user_name, text in batch).encode('utf-8')
+        try:
+            # one write per batch, so the workers of a cluster can append to the same file
+            fd = os.open(self.__filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self.stored += len(batch)
+        except OSError as ex:
+            logging.error(f'ERROR FEEDBACK - {str(ex)}')
+            with self.__lock:
+                self.__pending[:0] = batch  # retried with the next flush
+
+    def __legacy_entries(self) -> typing.List[T_Entry]:
+        # the feedback files of earlier versions, which are all older than the log. the file names have no year,
+        # so the time is the one of the last modification
+        directory = os.path.dirname(self.__filename) or '.'
+        entries = list()
+        try:
+            file_names = [file_name for file_name in os.listdir(directory)
+                          if file_name.startswith(FeedbackStore.LEGACY_PREFIX) and file_name.endswith('.txt')]
+        except OSError:
+            return entries
+        for file_name in file_names:
+            path = f'{directory}/{file_name}'
+            try:
+                with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                    text = file.read()
+                user_name = file_name[len(FeedbackStore.LEGACY_PREFIX) + FeedbackStore.LEGACY_DATE_LENGTH:-len('.txt')]
+                entries.append((os.path.getmtime(path), user_name, text))
+            except OSError as ex:
+                logging.error(str(ex))
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def __entries(self) -> typing.Iterator[T_Entry]:
+        # the feedback of earlier versions, the stored feedback and then the pending one, oldest first
+        yield from self.__legacy_entries()
+        try:
+            with open(self.__filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        yield entry['time'], entry['user'], entry['text']
+                    except (ValueError, KeyError, TypeError):
+                        continue  # e.g. a line cut by a crash
+        except FileNotFoundError:
+            pass
+        with self.__lock:
+            pending = list(self.__pending)
+        yield from pending
+
+    def query(self, user_name: str = '', since: float = 0.0, until: float = float('inf'), page: int = 1,
+              page_size: int = 20) -> typing.Tuple[int, typing.List[T_Entry]]:
+        # returns the number of matching entries and the page of them, newest first. reads the file once and
+        # keeps only the entries up to the requested page
+        newest: typing.Deque[T_Entry] = deque(maxlen=page * page_size)
+        total = 0
+        for entry in self.__entries():
+            if since <= entry[0] < until and (not user_name or entry[1] == user_name):
+                newest.append(entry)
+                total += 1
+        end = len(newest) - (page - 1) * page_size  # the entries of the previous pages are at the end
+        entries = list(newest)[max(end - page_size, 0):max(end, 0)]
+        return total, list(reversed(entries))
+
+    def get_info(self) -> str:
+        return f'feedback: {self.stored} stored / {len(self.__pending)} pending / {self.dropped} dropped'
+
+    @staticmethod
+    def format(entry: T_Entry) -> str:
+        t, user_name, text = entry
+        return f'{datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")} {user_name}\n{text}'
@@ -0,0 +1,73 @@
+import typing
+
+from chessServer.shared import BUFFER_SIZE, ETX, sock
+
+ETX_BYTE = ord(ETX)
+ETX_BYTES = ETX.encode('ascii')
+
+
+def decode(frame: bytes) -> str:
+    # a bad byte replaces a character of its own message and must not end the connection
+    return frame.decode('utf-8', errors='replace')
+
+
+class FrameBuffer:
+    # collects received bytes and splits them into ETX terminated messages. the bytes are decoded per
+    # complete message, so a multi-byte character split between two reads stays intact
+    RECEIVE_SIZE = BUFFER_SIZE  # bytes read from the socket at once
+    MAX_FRAME = 2 ** 16  # bytes of a message a server takes, like the default limit of asyncio.StreamReader
+
+    def __init__(self, max_frame: typing.Union[int, None] = None):
+        self.__data = bytearray()
+        self.__scanned = 0  # the bytes before this offset contain no ETX
+        self.__max_frame = max_frame  # a longer incomplete message ends the connection, None takes any length
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def receive(self, skt: sock) -> int:
+        # reads once from the socket. returns the number of bytes read, 0 if the peer closed the connection
+        data = skt.recv(FrameBuffer.RECEIVE_SIZE)
+        self.__data += data
+        return len(data)
+
+    def feed(self, data: bytes) -> None:
+        self.__data += data
+
+    def take(self, other: 'FrameBuffer') -> None:
+        # appends the bytes buffered by other and clears other
+        self.__data += other.__data
+        other.__data = bytearray()
+        other.__scanned = 0
+
+    def next_message(self) -> typing.Union[str, None]:
+        # returns the next complete message or None
+        end = self.__data.find(ETX_BYTE, self.__scanned)
+        if end < 0:
+            self.__scanned = len(self.__data)
+            self.__check_length()
+            return None
+        frame = self.__data[:end]
+        del self.__data[:end + 1]  # cheap, a bytearray keeps an offset for deletions at its start
+        self.__scanned = 0
+        return decode(frame)
+
+    def messages(self) -> typing.List[str]:
+        # returns all complete messages which are buffered. each frame is decoded on its own, so a bad byte only
+        # replaces a character of its own message
+        end = self.__data.rfind(ETX_BYTE, self.__scanned)
+        if end < 0:
+            self.__scanned = len(self.__data)
+            self.__check_length()
+            return list()
+        frames = self.__data[:end]
+        del self.__data[:end + 1]
+        self.__scanned = 0
+        self.__check_length()
+        return [decode(frame) for frame in frames.split(ETX_BYTES)]
+
+    def __check_length(self) -> None:
+        # the buffered bytes after the last ETX are one incomplete message. a complete message is at most
+        # RECEIVE_SIZE bytes longer than the limit, as the bytes are checked after each read
+        if self.__max_frame is not None and len(self.__data) > self.__max_frame:
+            raise ConnectionAbortedError('message too long')
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import re
+import time
+import typing
+from threading import Event, Lock, Thread
+
+T_Apply = typing.Callable[[list, list], list]  # rows and removed ids -> rows not written, see Database.update
+
+SEGMENT = re.compile(r'^(journal(?:-[\w-]+)?)-(\d+)\.log$')  # journal name, segment number
+
+
+class RatingJournal(Thread):
+    # the rows of users whose rating changed, appended to a file and synced to disk in groups. the database is
+    # only written every DB_UPDATE_INTERVAL, the journal keeps the results of the games played meanwhile.
+    # every database update starts a new segment, the older segments are deleted once the update is written
+    GROUP_COMMIT_INTERVAL = 0.1  # seconds, longest time until a result is on disk
+
+    def __init__(self, directory: str, journal: str = 'journal', name: str = 'journal'):
+        super(RatingJournal, self).__init__(name=name)
+        self.daemon = True
+        self.__directory = directory
+        self.__journal = journal  # the segments are named journal-000001.log, ...
+        self.__segment = max(RatingJournal.get_segments(directory).get(journal, [0])) + 1
+        self.__pending: typing.List[typing.Tuple[int, str]] = list()  # segment, line
+        self.__truncate = 0  # segments up to this one are in the database
+        self.__truncated = 0
+        self.__lock = Lock()
+        self.__stopped = Event()
+        self.commits = 0
+        self.entries = 0
+
+    @staticmethod
+    def get_segments(directory: str) -> typing.Dict[str, typing.List[int]]:
+        # journal name -> numbers of its segments
+        segments = dict()
+        for file_name in os.listdir(directory):
+            match = SEGMENT.match(file_name)
+            if match:
+                segments.setdefault(match.group(1), list()).append(int(match.group(2)))
+        return segments
+
+    def __file_name(self, name: str, segment: int) -> str:
+        return f'{self.__directory}/{name}-{segment:06d}.log'
+
+    def add(self, row: tuple) -> None:
+        # row: see User.to_row
+        self.__append({'t': time.time(), 'row': row})
+
+    def add_removal(self, user_id: int) -> None:
+        self.__append({'t': time.time(), 'removed': user_id})
+
+    def __append(self, entry: dict) -> None:
+        line = json.dumps(entry) + '\n'
+        with self.__lock:
+            self.__pending.append((self.__segment, line))
+
+    def rotate(self) -> int:
+        # called when the database update takes its snapshot of the users. returns the last segment it covers
+        with self.__lock:
+            self.__segment += 1
+            return self.__segment - 1
+
+    def truncate(self, segment: int) -> None:
+        # the database update of the segment is written, called by the persistence thread
+        with self.__lock:
+            self.__truncate = max(self.__truncate, segment)
+
+    def run(self) -> None:
+        while not self.__stopped.wait(RatingJournal.GROUP_COMMIT_INTERVAL):
+            self.__commit()
+        self.__commit()
+        logging.info(f'{self.name} interrupted')
+
+    def stop(self) -> None:
+        self.__stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def __commit(self) -> None:
+        with self.__lock:
+            pending, self.__pending = self.__pending, list()
+            truncate = self.__truncate
+        by_segment: typing.Dict[int, typing.List[str]] = dict()
+        for segment, line in pending:
+            by_segment.setdefault(segment, list()).append(line)
+        for segment, lines in sorted(by_segment.items()):
+            try:
+                with open(self.__file_name(self.__journal, segment), 'a', encoding='utf-8') as file:
+                    file.write(''.join(lines))
+                    file.flush()
+                    os.fsync(file.fileno())
+                self.entries += len(lines)
+            except OSError as ex:
+                logging.error(f'ERROR JOURNAL - {str(ex)}')
+                with self.__lock:
+                    self.__pending[:0] = [(segment, line) for line in lines]  # retried with the next commit
+        if pending:
+            self.commits += 1
+        if truncate > self.__truncated:
+            # after the pending lines of the segments are written, so no deleted segment is created again
+            for segment in RatingJournal.get_segments(self.__directory).get(self.__journal, []):
+                if segment <= truncate:
+                    self.__remove(self.__journal, segment)
+            self.__truncated = truncate
+
+    def __remove(self, name: str, segment: int) -> None:
+        try:
+            os.remove(self.__file_name(name, segment))
+        except OSError as ex:
+            logging.error(f'ERROR JOURNAL - {str(ex)}')
+
+    def replay(self, apply: T_Apply, names: typing.Iterable[str]) -> int:
+        # folds the segments of the journals into the users table in one pass: the latest entry of every user is
+        # written, then the segments are deleted. returns the number of users
+        latest: typing.Dict[int, dict] = dict()
+        segments = RatingJournal.get_segments(self.__directory)
+        files = [(name, segment) for name in names for segment in sorted(segments.get(name, []))]
+        for name, segment in files:
+            with open(self.__file_name(name, segment), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        user_id = entry['row'][0] if 'row' in entry else entry['removed']
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        continue  # e.g. a line cut by a crash
+                    if user_id not in latest or latest[user_id]['t'] <= entry['t']:
+                        latest[user_id] = entry
+        if not files:
+            return 0
+        rows = [tuple(entry['row']) for entry in latest.values() if 'row' in entry]
+        removed_ids = [entry['removed'] for entry in latest.values() if 'removed' in entry]
+        bad_rows = apply(rows, removed_ids)
+        if bad_rows:
+            logging.error(f'ERROR JOURNAL - rows skipped: {", ".join(str(row) for row in bad_rows)}')
+        for name, segment in files:
+            self.__remove(name, segment)
+        return len(latest)
+
+    def get_info(self) -> str:
+        return f'journal: {self.entries} entries in {self.commits} commits / segment {self.__segment}'
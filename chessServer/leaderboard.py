@@ -0,0 +1,66 @@
+import bisect
+import typing
+from threading import Lock
+
+T_Key = typing.Tuple[int, int]  # (-rating, user id): ascending keys are descending ratings
+
+
+class Leaderboard:
+    # ratings of all users who played, kept in order so a rating change does not sort all users again.
+    # an update moves the keys behind the changed one (bisect.insort is O(n)): ~30us at 100k users and ~0.4ms at
+    # one million, for each player of a game. beyond that a tree or a bucketed list is needed
+
+    def __init__(self):
+        self.__keys: typing.List[T_Key] = list()
+        self.__entries: typing.Dict[int, typing.Tuple[T_Key, str]] = dict()  # user id -> (key, name)
+        self.__lock = Lock()
+        self.version = 0  # changes with the order or a rating
+
+    def load(self, rows: typing.Iterable[typing.Tuple[int, str, int]]) -> None:
+        # rows: (user id, name, rating), see Database.get_ratings
+        with self.__lock:
+            for user_id, name, rating in rows:
+                self.__entries[user_id] = ((-rating, user_id), name)
+            self.__keys = sorted(key for key, _ in self.__entries.values())
+            self.version += 1
+
+    def update(self, user_id: int, name: str, rating: int) -> None:
+        key = (-rating, user_id)
+        with self.__lock:
+            entry = self.__entries.get(user_id)
+            if entry and entry[0] == key:
+                return
+            if entry:
+                self.__discard(entry[0])
+            bisect.insort(self.__keys, key)
+            self.__entries[user_id] = (key, name)
+            self.version += 1
+
+    def remove(self, user_id: int) -> None:
+        with self.__lock:
+            entry = self.__entries.pop(user_id, None)
+            if entry:
+                self.__discard(entry[0])
+                self.version += 1
+
+    def __discard(self, key: T_Key) -> None:
+        i = bisect.bisect_left(self.__keys, key)
+        if i < len(self.__keys) and self.__keys[i] == key:
+            del self.__keys[i]
+
+    def top(self, n: int) -> typing.List[typing.Tuple[int, str, int]]:
+        # (user id, name, rating) of the n best users
+        with self.__lock:
+            return [(user_id, self.__entries[user_id][1], -negative_rating)
+                    for negative_rating, user_id in self.__keys[:n]]
+
+    def rank(self, user_id: int) -> typing.Union[int, None]:
+        # users with the same rating share the rank
+        with self.__lock:
+            entry = self.__entries.get(user_id)
+            if not entry:
+                return None
+            return bisect.bisect_left(self.__keys, (entry[0][0], float('-inf'))) + 1
+
+    def __len__(self) -> int:
+        return len(self.__keys)
@@ -0,0 +1,107 @@
+import math
+import typing
+from collections import OrderedDict, deque
+
+T_Pair = typing.Tuple[typing.Any, typing.Any]
+
+
+class Matchmaker:
+    # pairs waiting players of similar rating. players are kept in rating buckets, so a new player is matched
+    # at once if a close opponent waits. the accepted rating gap grows with the waiting time
+    BUCKET_SIZE = 50  # elo points per bucket
+    MIN_GAP = 100  # accepted rating gap of a player who just started waiting
+    GAP_PER_SECOND = 40  # the gap widens by this while a player waits
+    MATCH_INTERVAL = 1  # seconds between passes which match players with widened gaps
+    STATS_SIZE = 1000  # number of recent waiting times for the statistics
+
+    def __init__(self, max_wait: float):
+        # players who waited max_wait seconds accept any opponent
+        self.__max_wait = max_wait
+        self.__buckets: typing.Dict[int, OrderedDict] = dict()  # bucket -> OrderedDict(player -> since)
+        self.__waiting: typing.Dict[typing.Any, typing.Tuple[float, int]] = dict()  # player -> (since, bucket)
+        self.__waits: deque = deque(maxlen=Matchmaker.STATS_SIZE)
+        self.matches = 0
+
+    def __len__(self) -> int:
+        return len(self.__waiting)
+
+    def __contains__(self, player) -> bool:
+        return player in self.__waiting
+
+    def add(self, player, now: float) -> typing.Union[typing.Any, None]:
+        # returns the opponent if there is a close match, otherwise the player waits
+        if player in self.__waiting:
+            return None
+        opponent = self.__find_opponent(player, self.__gap(0.0), now)
+        if opponent:
+            self.__pair(player, now, opponent, now)
+            return opponent
+        bucket = self.__bucket(player)
+        self.__buckets.setdefault(bucket, OrderedDict())[player] = now
+        self.__waiting[player] = (now, bucket)
+        return None
+
+    def remove(self, player) -> None:
+        entry = self.__waiting.pop(player, None)
+        if entry:
+            since, bucket = entry
+            players = self.__buckets[bucket]
+            players.pop(player)
+            if not players:
+                self.__buckets.pop(bucket)
+
+    def match(self, now: float) -> typing.List[T_Pair]:
+        # pairs players whose gap has widened enough. the longest waiting players are matched first
+        pairs = list()
+        for player, (since, _) in list(self.__waiting.items()):  # in order of arrival
+            if player not in self.__waiting:
+                continue  # already paired in this pass
+            opponent = self.__find_opponent(player, self.__gap(now - since), now)
+            if opponent:
+                self.remove(player)
+                self.__pair(player, since, opponent, now)
+                pairs.append((player, opponent))
+        return pairs
+
+    def __gap(self, wait: float) -> float:
+        if wait >= self.__max_wait:
+            return math.inf
+        return Matchmaker.MIN_GAP + Matchmaker.GAP_PER_SECOND * wait
+
+    @staticmethod
+    def __bucket(player) -> int:
+        return player.rating // Matchmaker.BUCKET_SIZE
+
+    def __find_opponent(self, player, gap: float, now: float) -> typing.Union[typing.Any, None]:
+        # the closest bucket first, within a bucket the longest waiting player
+        bucket = self.__bucket(player)
+        if gap == math.inf:
+            buckets = sorted(self.__buckets, key=lambda b: abs(b - bucket))
+        else:
+            reach = math.ceil(gap / Matchmaker.BUCKET_SIZE)
+            buckets = [bucket]
+            for distance in range(1, reach + 1):
+                buckets += [bucket + distance, bucket - distance]
+        for b in buckets:
+            for opponent, since in self.__buckets.get(b, dict()).items():
+                if opponent is player:
+                    continue
+                if abs(opponent.rating - player.rating) <= max(gap, self.__gap(now - since)):
+                    return opponent
+        return None
+
+    def __pair(self, player, player_since: float, opponent, now: float) -> None:
+        opponent_since = self.__waiting[opponent][0]
+        self.remove(opponent)
+        self.__waits.append(now - player_since)
+        self.__waits.append(now - opponent_since)
+        self.matches += 1
+
+    def get_info(self) -> str:
+        waits = sorted(self.__waits)
+        if not waits:
+            return f'matchmaking: waiting {len(self)} / matched {self.matches}'
+        p50 = waits[len(waits) // 2]
+        p99 = waits[min(len(waits) - 1, len(waits) * 99 // 100)]
+        return f'matchmaking: waiting {len(self)} / matched {self.matches}\n' \
+               f'time to match: p50 {p50:.1f}s / p99 {p99:.1f}s / max {waits[-1]:.1f}s'
@@ -0,0 +1,163 @@
+import logging
+import typing
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+T_Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+# upper bounds in seconds, from 100us to 10s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    # a value which only grows, e.g. the received frames. is written by one thread only
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    # counts observations in fixed buckets, so recording costs a bisect and no memory grows
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts values above all buckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.__lock = Lock()  # e.g. the handshakes are observed by several threads
+
+    def observe(self, value: float) -> None:
+        with self.__lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket which holds the quantile, at most the largest value
+        rank = q * self.count
+        total = 0
+        for n, count in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return min(self.buckets[n], self.max) if n < len(self.buckets) else self.max
+        return 0.0
+
+
+class Metrics:
+    # the counters, histograms and gauges of a server. they are read by the admin command 'metrics' and in the
+    # Prometheus text format, see MetricsEndpoint
+
+    def __init__(self):
+        self.__families: typing.Dict[str, typing.Tuple[str, str, dict]] = dict()  # name -> (type, help, metrics)
+        self.__lock = Lock()
+
+    def counter(self, name: str, description: str, **labels: str) -> Counter:
+        return self.__get(name, 'counter', description, labels, Counter)
+
+    def histogram(self, name: str, description: str, buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+                  **labels: str) -> Histogram:
+        return self.__get(name, 'histogram', description, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, description: str, read: typing.Callable[[], float], **labels: str) -> None:
+        # the value is read when the metrics are rendered
+        self.__get(name, 'gauge', description, labels, lambda: read)
+
+    def __get(self, name: str, kind: str, description: str, labels: dict, create: typing.Callable):
+        key: T_Labels = tuple(sorted(labels.items()))
+        family = self.__families.get(name)
+        if family and key in family[2]:
+            return family[2][key]
+        with self.__lock:
+            family = self.__families.setdefault(name, (kind, description, dict()))
+            return family[2].setdefault(key, create())
+
+    @staticmethod
+    def __format_labels(labels: T_Labels, **extra: str) -> str:
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    @staticmethod
+    def __value(metric) -> float:
+        if isinstance(metric, Counter):
+            return metric.value
+        try:
+            return metric()
+        except Exception as ex:
+            logging.debug(str(ex))
+            return float('nan')
+
+    def render(self) -> str:
+        # the Prometheus text exposition format
+        out = list()
+        for name, (kind, description, metrics) in list(self.__families.items()):
+            out.append(f'# HELP {name} {description}')
+            out.append(f'# TYPE {name} {kind}')
+            for labels, metric in list(metrics.items()):
+                if kind != 'histogram':
+                    out.append(f'{name}{self.__format_labels(labels)} {self.__value(metric)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets, metric.counts):
+                    cumulative += count
+                    out.append(f'{name}_bucket{self.__format_labels(labels, le=str(bound))} {cumulative}')
+                out.append(f'{name}_bucket{self.__format_labels(labels, le="+Inf")} {metric.count}')
+                out.append(f'{name}_sum{self.__format_labels(labels)} {metric.sum}')
+                out.append(f'{name}_count{self.__format_labels(labels)} {metric.count}')
+        return '\n'.join(out) + '\n'
+
+    def get_info(self) -> str:
+        # one line per metric, histograms with their quantiles in milliseconds
+        out = list()
+        for name, (kind, _, metrics) in list(self.__families.items()):
+            for labels, metric in list(metrics.items()):
+                label = name + self.__format_labels(labels)
+                if kind != 'histogram':
+                    out.append(f'{label}: {self.__value(metric):g}')
+                elif metric.count:
+                    out.append(f'{label}: {metric.count} / p50 {1000 * metric.quantile(0.5):.2f}ms / '
+                               f'p99 {1000 * metric.quantile(0.99):.2f}ms / max {1000 * metric.max:.2f}ms')
+                else:
+                    out.append(f'{label}: 0')
+        return '\n'.join(out)
+
+
+class MetricsEndpoint(Thread):
+    # serves the metrics in the Prometheus text format on a local port, e.g. http://127.0.0.1:9100/metrics
+
+    def __init__(self, metrics: Metrics, port: int, name: str = 'metrics endpoint'):
+        super(MetricsEndpoint, self).__init__(name=name)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass  # scraped every few seconds
+
+        self.__http_server = HTTPServer(('127.0.0.1', port), Handler)
+
+    def run(self) -> None:
+        logging.info(f'{self.name} on port {self.__http_server.server_address[1]}')
+        self.__http_server.serve_forever()
+
+    def stop(self) -> None:
+        if self.is_alive():
+            self.__http_server.shutdown()
+        self.__http_server.server_close()
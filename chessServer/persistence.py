@@ -0,0 +1,93 @@
+import logging
+import time
+import typing
+from queue import Queue
+from threading import Lock, Thread
+
+from chessServer.database import Database
+from chessServer.metrics import Histogram
+
+T_Job = typing.Union[typing.Callable[[Database], None], None]
+
+
+class Persistence(Thread):
+    # owns the database connection and writes the queued updates, so no other thread waits for the disk
+
+    def __init__(self, filename: str, name: str = 'persistence', flush_seconds: typing.Union[Histogram, None] = None):
+        super(Persistence, self).__init__(name=name)
+        self.__filename = filename
+        self.flush_seconds = flush_seconds or Histogram()
+        self.__queue: Queue = Queue()
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0  # rows which could not be written, see Database.update
+        self.last_latency = 0.0  # seconds
+        self.max_latency = 0.0
+        self.__pending: typing.Dict[int, int] = dict()  # user id -> number of queued updates
+        self.__pending_lock = Lock()
+
+    def update_users(self, rows: list, removed_ids: list,
+                     on_failure: typing.Callable[[], None] = lambda: None,
+                     on_success: typing.Callable[[], None] = lambda: None) -> None:
+        # rows are snapshots (see User.to_row), so the users can change while the update is queued
+        ids = [row[0] for row in rows] + list(removed_ids)
+        self.__track(ids, 1)
+
+        def job(db: Database) -> None:
+            try:
+                bad_rows = db.update(rows, removed_ids)
+            except Exception:
+                on_failure()  # e.g. the disk is full, the users are written with the next update
+                raise
+            finally:
+                self.__track(ids, -1)
+            if bad_rows:
+                self.dropped += len(bad_rows)
+                logging.error(f'ERROR DB UPDATE - rows dropped: {", ".join(str(row) for row in bad_rows)}')
+            on_success()
+
+        self.__queue.put(job)
+
+    def is_pending(self, user_id: int) -> bool:
+        # True while the database row of the user is about to be changed
+        return user_id in self.__pending
+
+    def __track(self, ids: list, delta: int) -> None:
+        with self.__pending_lock:
+            for _id in ids:
+                count = self.__pending.get(_id, 0) + delta
+                if count > 0:
+                    self.__pending[_id] = count
+                else:
+                    self.__pending.pop(_id, None)
+
+    def queue_depth(self) -> int:
+        return self.__queue.qsize()
+
+    def get_info(self) -> str:
+        return f'db queue: {self.queue_depth()}\n' \
+               f'db flushes: {self.flushes} (failed: {self.failures} / rows dropped: {self.dropped})\n' \
+               f'db flush latency: {1000 * self.last_latency:.1f}ms (max: {1000 * self.max_latency:.1f}ms)'
+
+    def stop(self) -> None:
+        # queued updates are written before the thread ends
+        self.__queue.put(None)
+
+    def run(self) -> None:
+        db = Database(self.__filename)
+        while True:
+            job: T_Job = self.__queue.get()
+            if job is None:
+                break
+            t0 = time.time()
+            try:
+                job(db)
+                self.flushes += 1
+            except Exception as ex:
+                self.failures += 1
+                logging.error('ERROR DB UPDATE - ' + str(ex))
+            self.last_latency = time.time() - t0
+            self.flush_seconds.observe(self.last_latency)
+            self.max_latency = max(self.max_latency, self.last_latency)
+        db.close()
+        logging.info(f'{self.name} interrupted')
@@ -0,0 +1,91 @@
+import os
+import re
+import sys
+import threading
+import tracemalloc
+import typing
+from threading import Event, Thread
+
+T_Stack = typing.Tuple[str, ...]  # thread name, then the functions from the outermost to the innermost call
+
+
+class Sampler(Thread):
+    # a sampling profiler: records the call stacks of all other threads at a fixed interval. in contrast to
+    # cProfile it covers threads which are already running, e.g. the main loop. costs nothing while it is stopped
+    INTERVAL = 0.005  # seconds between samples
+
+    def __init__(self, name: str = 'profiler'):
+        super(Sampler, self).__init__(name=name)
+        self.daemon = True
+        self.samples = 0
+        self.__stacks: typing.Dict[T_Stack, int] = dict()  # stack -> number of samples
+        self.__stopped = Event()
+
+    def run(self) -> None:
+        while not self.__stopped.wait(Sampler.INTERVAL):
+            self.__sample()
+
+    def stop(self) -> None:
+        self.__stopped.set()
+        self.join()
+
+    def __sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = list()
+            while frame:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = tuple(reversed(stack))
+            self.__stacks[key] = self.__stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def write(self, filename: str) -> None:
+        # one line per stack in the collapsed format of flamegraph.pl and speedscope
+        with open(filename, 'w') as file:
+            for stack, count in sorted(self.__stacks.items()):
+                file.write(f'{";".join(stack)} {count}\n')
+
+    def get_summary(self, top: int = 5) -> str:
+        # the functions which were running most often, per thread. the threads of a pool are averaged
+        threads: typing.Dict[str, typing.Dict[str, int]] = dict()
+        pools: typing.Dict[str, typing.Set[str]] = dict()
+        for stack, count in self.__stacks.items():
+            name = re.sub(r'_\d+$', '', stack[0])
+            pools.setdefault(name, set()).add(stack[0])
+            functions = threads.setdefault(name, dict())
+            leaf = stack[-1] if len(stack) > 1 else '?'
+            functions[leaf] = functions.get(leaf, 0) + count
+        out = [f'{self.samples} samples every {1000 * Sampler.INTERVAL:g}ms']
+        for name, functions in sorted(threads.items()):
+            size = len(pools[name])
+            out.append(f'{name} ({size} threads):' if size > 1 else f'{name}:')
+            for function, count in sorted(functions.items(), key=lambda item: -item[1])[:top]:
+                out.append(f'  {100 * count / max(self.samples * size, 1):5.1f}% {function}')
+        return '\n'.join(out)
+
+
+def take_memory_snapshot(filename: str, previous: typing.Union[tracemalloc.Snapshot, None],
+                         top: int = 10) -> typing.Tuple[tracemalloc.Snapshot, str]:
+    # writes a snapshot of the traced allocations and returns it with the largest allocations by line,
+    # compared to the previous snapshot if there is one
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    snapshot.dump(filename)
+    current, peak = tracemalloc.get_traced_memory()
+    out = [f'traced: {current / 2 ** 20:.1f}MB (peak: {peak / 2 ** 20:.1f}MB)']
+    if previous:
+        out.append('largest changes since the last snapshot:')
+        for stat in snapshot.compare_to(previous, 'lineno')[:top]:
+            out.append(str(stat))
+    else:
+        out.append('largest allocations:')
+        for stat in snapshot.statistics('lineno')[:top]:
+            out.append(str(stat))
+    return snapshot, '\n'.join(out)
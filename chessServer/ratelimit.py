@@ -0,0 +1,74 @@
+import ipaddress
+import typing
+
+T_Limit = typing.Union[typing.Tuple[float, float], None]  # tokens per second and burst, None for no limit
+
+
+class TokenBucket:
+    # holds up to burst tokens and gains rate tokens per second. a connection takes one token
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> float:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class AcceptLimiter:
+    # rate limits of new connections per address, per network (/24 for IPv4, /64 for IPv6) and in total. is used
+    # by the thread which accepts the connections only, so a refused connection costs no lock
+    PRUNE_INTERVAL = 60  # seconds between removals of the buckets which are full again
+
+    def __init__(self, per_ip: T_Limit, per_prefix: T_Limit, total: T_Limit):
+        self.__limits = (('ip', per_ip), ('prefix', per_prefix), ('global', total))
+        self.__buckets: typing.Tuple[typing.Dict[str, TokenBucket], ...] = (dict(), dict(), dict())
+        self.__pruned = 0.0
+
+    @staticmethod
+    def get_prefix(ip: str) -> str:
+        if ':' not in ip and ip.count('.') == 3:
+            return ip[:ip.rfind('.')] + '.0/24'  # the common case, without parsing the address
+        try:
+            address = ipaddress.ip_address(ip.split('%', 1)[0])  # without the zone of a link local address
+        except ValueError:
+            return ip
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        return str(ipaddress.ip_network((address, 24 if address.version == 4 else 64), strict=False))
+
+    def check(self, ip: str, now: float) -> str:
+        # takes a token of every limit and returns '', or the name of the exceeded limit and takes none
+        keys = (ip, AcceptLimiter.get_prefix(ip), '')
+        taken = list()
+        for key, (name, limit), buckets in zip(keys, self.__limits, self.__buckets):
+            if not limit:
+                continue
+            rate, burst = limit
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(burst, now)
+            if bucket.refill(rate, burst, now) < 1.0:
+                return name
+            taken.append(bucket)
+        for bucket in taken:
+            bucket.tokens -= 1.0
+        if now - self.__pruned > AcceptLimiter.PRUNE_INTERVAL:
+            self.__prune(now)
+        return ''
+
+    def __prune(self, now: float) -> None:
+        for (_, limit), buckets in zip(self.__limits, self.__buckets):
+            if not limit:
+                continue
+            rate, burst = limit
+            for key, bucket in list(buckets.items()):
+                if bucket.refill(rate, burst, now) >= burst:
+                    del buckets[key]  # the same as a new bucket
+        self.__pruned = now
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self.__buckets)
@@ -1,33 +1,93 @@
+import heapq
 import logging
 import os
-import sqlite3
+import selectors
+import struct
 import threading
 import time
 import traceback
+import tracemalloc
 import typing
-from datetime import datetime
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
 from random import randint
-from socket import timeout
+from concurrent.futures import Future, ThreadPoolExecutor
+from socket import IPPROTO_TCP, SO_LINGER, SOL_SOCKET, TCP_NODELAY, socketpair, timeout
 from threading import Thread
 from typing import Dict, Set
 
 from chessServer import Database
+from chessServer.archive import RESULTS, Game, GameArchive
+from chessServer.feedback import FeedbackStore
+from chessServer.journal import RatingJournal
+from chessServer.leaderboard import Leaderboard
+from chessServer.matchmaker import Matchmaker
+from chessServer.metrics import Metrics, MetricsEndpoint
+from chessServer.persistence import Persistence
+from chessServer.profiler import Sampler, take_memory_snapshot
+from chessServer.ratelimit import AcceptLimiter
 from chessServer.shared import *
 from chessServer.user import User
 
 T_User = typing.Union[User, None]
 T_Socket = typing.Union[sock, None]
 T_Port = typing.Union[str, int]
+T_Arrival = typing.Tuple[User, str, str, T_User, float]  # connection, name, password, stored user, accepted
+T_Reply = typing.Callable[[str], None]
+
+
+class Snapshot:
+    # the server state read by the admin commands. the main loop takes shallow copies of the collections, the admin
+    # worker reads them while the games go on. the users themselves are shared
+    __slots__ = ('online_users', 'online_users_by_name', 'users_by_name', 'linked_users', 'ip_addresses',
+                 'registered_users', 'users_in_memory', 'last_game')
+
+    def __init__(self, online_users: typing.Collection[User], online_users_by_name: typing.Mapping[str, User],
+                 users_by_name: typing.Mapping[str, User], linked_users: typing.Mapping[User, User],
+                 ip_addresses: typing.Mapping[str, int], registered_users: int, users_in_memory: int, last_game: str):
+        self.online_users = online_users
+        self.online_users_by_name = online_users_by_name
+        self.users_by_name = users_by_name
+        self.linked_users = linked_users
+        self.ip_addresses = ip_addresses
+        self.registered_users = registered_users
+        self.users_in_memory = users_in_memory
+        self.last_game = last_game
+
+    def count_offline_users(self) -> int:
+        return max(self.registered_users - len(self.online_users), 0)
 
 
 class Server:
     MAX_ATTEMPTS = 5
     TIMEOUT = 5
-    BACKLOG = 10
+    BACKLOG = 512  # pending connections queued by the os, e.g. when all clients reconnect after a restart
+    HANDSHAKE_WORKERS = 32  # admittances running concurrently
+    HANDSHAKE_TIMEOUT = 3  # deadline for authentication, name and password of a new connection
+    # admittances queued or running, beyond new connections are refused at once, so a few slow clients cannot
+    # hold all handshake workers:
+    HANDSHAKES_PER_IP = 4  # of one address
+    HANDSHAKES_PER_PREFIX = 16  # of a /24 (IPv4) or /64 (IPv6) network
+    MAX_HANDSHAKES = 2 * HANDSHAKE_WORKERS  # of all addresses
     MAX_PER_IP = 25
-    LINK_INTERVAL = 10
-    DB_UPDATE_INTERVAL = 3600
+    # token buckets of new connections, checked before anything is read: per second and burst, None for no limit
+    ACCEPT_LIMIT_IP = (2.0, 30)  # of one address
+    ACCEPT_LIMIT_PREFIX = (10.0, 100)  # of a /24 (IPv4) or /64 (IPv6) network
+    ACCEPT_LIMIT = (200.0, 1000)  # of all addresses
+    LINK_INTERVAL = 10  # longest wait for an opponent of similar rating, then any opponent is accepted
+    DB_UPDATE_INTERVAL = 60  # only changed users are written
+    SELECT_TIMEOUT = 1  # longest time the main loop waits for readable sockets
+    USER_CACHE_SIZE = 10000  # offline users kept in memory, the others are loaded from the database on demand
+    PAGE_SIZE = 50  # users per page of the admin command 'get'
+    # admin commands which change the server state run on the main loop, the others on the admin worker:
+    LOOP_COMMANDS = ('notify', 'notify_all', 'remove', 'resetpw', 'setlang', 'signoff', 'stop', 'update')
+    MESSAGE_BUDGET = 32  # messages of one user handled per main loop cycle, so others are not delayed
+    INBOX_LIMIT = 1024  # a user's socket is not read while this many messages are queued
+    HEARTBEAT_INTERVAL = 30  # a user who sent nothing for this long is sent %ECHO?
+    IDLE_TIMEOUT: typing.Union[float, None] = 90  # a user who sent nothing for this long is signed off, None to keep
+    METRICS_PORT: typing.Union[int, None] = None  # local port of the Prometheus endpoint, None to disable it
 
     # all time specifications in seconds
 
@@ -37,23 +97,46 @@ class Server:
         self.__port: int = int(port)
         self.__authentication = authentication
         self.__admin_authentication = admin_authentication
-        self.__server_socket = sock()
+        self._server_socket = sock()
         self._admin = None
         self._last_game: str = str()
+        self._leaderboard = Leaderboard()
+        self.__rating_chart: typing.Tuple[tuple, str] = (tuple(), str())  # cache key and chart
+        self._registered_users = 0
         self._ip_addresses: Dict[str, int] = dict()
-        self._all_users: Set[User] = set()
+        self._all_users: Set[User] = set()  # users in memory: online users and recently seen offline users
         self._online_users: Set[User] = set()
+        self._offline_users: typing.OrderedDict[str, User] = OrderedDict()  # least recently used first
+        self._users_by_name: Dict[str, User] = dict()  # index of _all_users
+        self._online_users_by_name: Dict[str, User] = dict()  # index of _online_users
         self._users_to_link: Set[User] = set()
-        self._unlinked_users: Set[User] = set()
-        self._user_wait_loop: Set[User] = set()
+        self._matchmaker = Matchmaker(Server.LINK_INTERVAL)  # the users to link by rating
         self._disconnected_users: Set[User] = set()
         self._linked_users: Dict[User, User] = dict()
-        self._lock = threading.Lock()
+        self._reader: typing.Union[Database, None] = None  # database connection to look users up
+        self._reader_lock = threading.Lock()
         self._stop = False
-
-        abs_path = Path('.').absolute()
-        sub_dir_name = f'data_{hostname}_{port}'.replace('.', '_')
-        self.DATA_DIR = f'{abs_path}/{sub_dir_name}'
+        self._users_loaded = False  # see _load_users_or_stop
+        self.__loaded = threading.Event()  # the ids and the database reader are ready, see _load_users
+        self.__handshakes: Dict[str, int] = dict()  # address or network -> admittances queued or running
+        self.__handshake_count = 0
+        self.__handshakes_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_receiver, self._wakeup_sender = socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ)  # data None marks the wakeup socket
+        self.__selected_admin: T_User = None
+        self.__messages_pending = False
+        self.__peak_inbox = 0  # most messages queued for one user
+        self.__unflushed: Set[User] = set()  # users with queued output, see __flush_users
+        self.__posted: typing.Deque[typing.Callable[[], None]] = deque()  # calls for the main loop, see _post
+        self.__arrivals: typing.Deque[T_Arrival] = deque()  # finished handshakes, see __add_users
+        self.__heartbeats: typing.List[typing.Tuple[float, int, User]] = list()  # heap of (due, id, user)
+        self.__heartbeat_due: Dict[User, float] = dict()  # the valid entry of an online user in __heartbeats
+
+        sub_dir_name = Server.get_sub_dir_name(hostname, port)
+        self.DATA_DIR = f'{Path(".").absolute()}/{sub_dir_name}'
         self.DATABASE_FILENAME = f'{self.DATA_DIR}/users.db'
         try:
             os.mkdir(self.DATA_DIR)
@@ -61,14 +144,69 @@ class Server:
         except FileExistsError:
             logging.info(f'directory {sub_dir_name} already exists')
 
+        self.metrics = Metrics()
+        self._cycle_seconds = self.metrics.histogram('chess_loop_cycle_seconds', 'work time of a main loop cycle')
+        self._handshake_seconds = self.metrics.histogram('chess_handshake_seconds', 'admittance of a connection')
+        self._frames_in = self.metrics.counter('chess_frames_received_total', 'messages received from clients')
+        self._frames_out = self.metrics.counter('chess_frames_sent_total', 'messages queued for clients')
+        self._bytes_in = self.metrics.counter('chess_bytes_received_total', 'bytes received from clients')
+        self._bytes_out = self.metrics.counter('chess_bytes_sent_total', 'bytes queued for clients')
+        self._accepted = self.metrics.counter('chess_connections_accepted_total', 'connections within the limits')
+        self._refused = {limit: self.metrics.counter('chess_connections_refused_total',
+                                                     'connections closed by an accept limit', limit=limit)
+                         for limit in ('ip', 'prefix', 'global', 'handshake_ip', 'handshake_prefix', 'handshakes')}
+        self._heartbeats_sent = self.metrics.counter('chess_heartbeats_sent_total', '%ECHO? sent to idle users')
+        self._reaped = self.metrics.counter('chess_users_reaped_total', 'users signed off after IDLE_TIMEOUT')
+        self.metrics.gauge('chess_users_online', 'online users', lambda: len(self._online_users))
+        self.metrics.gauge('chess_users_waiting', 'users waiting for an opponent', lambda: len(self._matchmaker))
+        self.metrics.gauge('chess_inbox_messages', 'received messages not yet handled',
+                           lambda: sum(len(user.messages or ()) for user in list(self._online_users)))
+        self.metrics.gauge('chess_db_queue', 'queued database updates', lambda: self._persistence.queue_depth())
+        self._persistence = Persistence(self.DATABASE_FILENAME, f'{sub_dir_name} persistence',
+                                        self.metrics.histogram('chess_db_flush_seconds', 'database update'))
+        self._feedback = FeedbackStore(f'{self.DATA_DIR}/feedback.log', f'{sub_dir_name} feedback')
+        self._archive = GameArchive(f'{self.DATA_DIR}/games.db', f'{sub_dir_name} archive')
+        self._journal = RatingJournal(self.DATA_DIR, 'journal', f'{sub_dir_name} journal')
+        self._games: Dict[User, Game] = dict()  # linked user -> game in progress
+        self._accept_limiter = AcceptLimiter(Server.ACCEPT_LIMIT_IP, Server.ACCEPT_LIMIT_PREFIX, Server.ACCEPT_LIMIT)
+        self.__metrics_endpoint: typing.Union[MetricsEndpoint, None] = None
+        self.__sampler: typing.Union[Sampler, None] = None  # running profiler, see the admin command 'profile'
+        self.__memory_snapshot: typing.Union[tracemalloc.Snapshot, None] = None  # see 'memsnap'
+        # runs the admin commands which only read the state, one at a time, see _admin_command:
+        self._admin_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{sub_dir_name} admin')
+
+    @staticmethod
+    def get_sub_dir_name(hostname: str, port: T_Port) -> str:
+        # the data directory of a server, in the working directory
+        return f'data_{hostname}_{port}'.replace('.', '_')
+
     def get_port(self) -> int:
         return self.__port
 
     def run(self):
+        if not self._bind():
+            return
+
+        self._persistence.start()
+        self._feedback.start()
+        self._archive.start()
+        self._journal.start()
+        self._start_metrics_endpoint()
+        main_loop = Thread(target=self.__main_loop, name=f'{self.SOCKET_NAME} main loop')
+        main_loop.start()
+        administrator = Thread(target=self._administrate, name=f'{self.SOCKET_NAME} administrator')
+        administrator.daemon = True
+        administrator.start()
+        request_manager = Thread(target=self.__manage_user_requests, name=f'{self.SOCKET_NAME}  request manager')
+        request_manager.start()
+
+    def _bind(self) -> bool:
+        # allow a restarted server to bind while connections of the previous run are in TIME_WAIT:
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # try to bind one of the ports from (port) to (port + max_attempts - 1):
         for attempt in range(Server.MAX_ATTEMPTS):
             try:
-                self.__server_socket.bind((self.HOSTNAME, self.__port))
+                self._server_socket.bind((self.HOSTNAME, self.__port))
                 break
             except OSError:
                 logging.info(f'binding {self.HOSTNAME}:{self.__port} failed')
@@ -77,23 +215,37 @@ class Server:
                     continue
                 else:
                     logging.info('binding not possible')
-                    return
+                    return False
 
-        self.SOCKET_NAME = str(self.__server_socket.getsockname())
+        self.SOCKET_NAME = str(self._server_socket.getsockname())
         logging.info(f'binding {self.SOCKET_NAME} successful')
+        return True
 
-        main_loop = Thread(target=self.__main_loop, name=f'{self.SOCKET_NAME} main loop')
-        main_loop.start()
-        administrator = Thread(target=self.__administrate, name=f'{self.SOCKET_NAME} administrator')
-        administrator.daemon = True
-        administrator.start()
-        request_manager = Thread(target=self.__manage_user_requests, name=f'{self.SOCKET_NAME}  request manager')
-        request_manager.start()
+    def _start_metrics_endpoint(self) -> None:
+        if Server.METRICS_PORT is None:
+            return
+        try:
+            self.__metrics_endpoint = MetricsEndpoint(self.metrics, Server.METRICS_PORT,
+                                                      f'{self.SOCKET_NAME} metrics endpoint')
+        except OSError as ex:
+            logging.error(f'metrics endpoint on port {Server.METRICS_PORT} not available - {str(ex)}')
+            return
+        self.__metrics_endpoint.start()
+
+    def _stop_metrics_endpoint(self) -> None:
+        if self.__metrics_endpoint:
+            self.__metrics_endpoint.stop()
+            self.__metrics_endpoint = None
 
     def register_user(self, user: User) -> None:
+        # runs on the main loop
         self.__add_ip(user.ip)
-        self._user_wait_loop.add(user)
+        user.on_pending = self.__schedule_flush
         self._all_users.add(user)
+        if self._users_by_name.get(user.get_name()) is not user:
+            self._registered_users += 1
+        self._users_by_name[user.get_name()] = user
+        self._set_users_online((user,))
 
     def sign_off(self, user: User) -> None:
         self._online_users.remove(user)
@@ -104,12 +256,49 @@ class Server:
     def remove_user(self, user: User) -> None:
         if user in self._online_users:
             self.sign_off(user)
-        self._all_users.remove(user)
+        self._all_users.discard(user)
+        self._users_by_name.pop(user.get_name(), None)
+        self._offline_users.pop(user.get_name(), None)
+        self._registered_users -= 1
+        self._leaderboard.remove(user.get_id())
+        self._journal.add_removal(user.get_id())
+        self._persistence.update_users([], [user.get_id()])
+
+    def broadcast(self, message: str) -> typing.Tuple[int, int, int]:
+        # encodes the message once and queues it for every online user without blocking. returns the number of
+        # users whose socket took it at once, whose rest is left to the main loop and who could not be reached
+        data = (message + ETX).encode('utf-8')
+        delivered = deferred = failed = 0
+        for user in self._online_users:
+            if not user.queue_frames(data):
+                failed += 1  # went offline meanwhile
+                continue
+            try:
+                flushed = user.flush()
+            except (ConnectionError, OSError) as ex:
+                logging.info(f'CONNECTION ERROR (SENDING DATA TO {user.get_name()}) {str(ex)}')
+                self._disconnected_users.add(user)
+                failed += 1
+                continue
+            if flushed:
+                delivered += 1
+            else:
+                deferred += 1
+                self.__unflushed.add(user)
+        if deferred or failed:
+            self.__wakeup()
+        self._frames_out.inc(delivered + deferred)
+        self._bytes_out.inc(len(data) * (delivered + deferred))
+        return delivered, deferred, failed
 
     def stop(self) -> None:
         self._stop = True
+        self.__wakeup()
 
-    def execute(self, command: str) -> str:
+    def execute(self, command: str, snapshot: typing.Union[Snapshot, None] = None) -> str:
+        # snapshot: the state read by the command, see _admin_command. without one the command reads the live state,
+        # so it has to run on the main loop
+        state = snapshot or self._take_snapshot(copy=False)
 
         def remove_user(args: list) -> str:
             if len(args) > 0:
@@ -134,19 +323,8 @@ class Server:
         def notify_all(args: list) -> str:
             if len(args) < 2:
                 return 'too few arguments - notify_all users *message*'  # todo ...
-            else:
-                for user in self._online_users:
-                    try:
-                        user.notify(args[1])
-                        logging.debug('{} notified'.format(user.get_name()))
-                    except ConnectionError as ex:
-                        logging.info(str(ex))
-                        self._disconnected_users.add(user)
-                        continue
-                    except Exception as ex:
-                        logging.error(str(ex))
-                        continue
-                return 'notified users'
+            delivered, deferred, failed = self.broadcast(args[1])
+            return f'notified users - {delivered} delivered / {deferred} deferred / {failed} failed'
 
         def sign_off_user(args: list) -> str:
             if len(args) == 0:
@@ -154,6 +332,8 @@ class Server:
             name = args[0]
             try:
                 user_to_del = self._get_online_user_by_name(name)
+                if not user_to_del:
+                    return f'no user online named {name}'
                 self.sign_off(user_to_del)
                 return 'signed off ' + name
             except ValueError as ex:
@@ -175,77 +355,112 @@ class Server:
                 else:
                     return 'no user named {}'.format(args[0])
 
-        def fetch_feedback(_) -> str:
-            feedback = list()
-            for file_name in os.listdir(self.DATA_DIR):
-                if file_name.endswith('.txt'):
-                    try:
-                        with open(f'{self.DATA_DIR}/{file_name}', 'r') as file:
-                            feedback.append(file.read())
-                    except Exception as ex:
-                        logging.error(str(ex))
-            return f'\n{SEPARATOR}\n'.join(feedback)
+        def fetch_feedback(args: list) -> str:
+            # feedback [user=*name*] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [page]
+            user_name, since, until, page = '', 0.0, float('inf'), 1
+            filters = list()
+            for arg in ' '.join(args).split():
+                key, _, value = arg.partition('=')
+                if value:
+                    filters.append(arg)
+                try:
+                    if key == 'user':
+                        user_name = value
+                    elif key == 'from':
+                        since = datetime.strptime(value, '%Y-%m-%d').timestamp()
+                    elif key == 'to':
+                        until = (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).timestamp()
+                    elif arg.isdigit() and int(arg) > 0:
+                        page = int(arg)
+                    else:
+                        return 'feedback [user=*name*] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [page]'
+                except ValueError:
+                    return f'invalid date {value} - YYYY-MM-DD'
+            total, entries = self._feedback.query(user_name, since, until, page, Server.PAGE_SIZE)
+            if not entries:
+                return 'no feedback' if page == 1 else f'no feedback on page {page}'
+            out = [f'\n{SEPARATOR}\n'.join(FeedbackStore.format(entry) for entry in entries), SEPARATOR,
+                   f'{total} feedback (page {page}, newest first)']
+            if total > page * Server.PAGE_SIZE:
+                out.append(f'next page: feedback {" ".join(filters + [str(page + 1)])}')
+            return '\n'.join(out)
 
         def get_info(_) -> str:
             return f'active threads: {str(threading.activeCount())}\n' \
-                   f'users: {len(self._all_users)}\n' \
-                   f'online: {len(self._online_users)}\n' \
-                   f'linked users: {len(self._linked_users)}'
+                   f'registered users: {state.registered_users}\n' \
+                   f'users in memory: {state.users_in_memory}\n' \
+                   f'online: {len(state.online_users)}\n' \
+                   f'linked users: {len(state.linked_users)}\n' \
+                   f'heartbeat: {self._heartbeats_sent.value} sent / {self._reaped.value} reaped ' \
+                   f'(idle timeout {Server.IDLE_TIMEOUT}s)\n' \
+                   f'{self._matchmaker.get_info()}\n' \
+                   f'{self._get_inbox_info(state.online_users)}\n' \
+                   f'{self._persistence.get_info()}\n' \
+                   f'{self._feedback.get_info()}\n' \
+                   f'{self._archive.get_info()}\n' \
+                   f'{self._journal.get_info()}'
 
         def update_db(_) -> str:
-            try:
-                db = Database(self.DATABASE_FILENAME)
-                db.clear()
-                db.insert(self._all_users)
-                db.save()
-                return 'database updated'
-            except sqlite3.OperationalError:
-                return 'update database not possible. most likely db is locked'
-            except Exception as ex:
-                return str("ERROR DB UPDATE - " + str(ex))
+            segment = self._journal.rotate()  # the results journaled so far are part of this update
+            changed_users = [user for user in self._all_users if user.dirty]
+            rows = list()
+            for user in changed_users:
+                user.dirty = False  # reset before the snapshot, so later changes mark the user again
+                rows.append(user.to_row())
+
+            def on_failure():
+                for changed_user in changed_users:
+                    changed_user.dirty = True
+
+            self._persistence.update_users(rows, [], on_failure, lambda: self._journal.truncate(segment))
+            return f'database update queued - changed: {len(rows)}\n' \
+                   f'{self._persistence.get_info()}'
 
         def get_rating_chart(_) -> str:
+            top = self._leaderboard.top(10)
+            online = tuple(name in state.online_users_by_name for _, name, _ in top)
+            key = (self._leaderboard.version, online, len(state.online_users), state.registered_users,
+                   state.last_game)
+            if self.__rating_chart[0] == key:
+                return self.__rating_chart[1]
+
             out = list()
-            users = list(self._all_users)
-            users.sort(key=lambda c: c.rating, reverse=True)
-            n = 0
-            for user in users:
-                if user in self._online_users:
-                    online_marker = '(*)'
-                else:
-                    online_marker = '(o)'
-                if user.played_games > 0:
-                    out.append(f'{n + 1}. {online_marker} {user.get_name()} - {user.rating}')
-                    n += 1
-                if n >= 10:
-                    break
+            for n, (_, name, rating) in enumerate(top):
+                online_marker = '(*)' if online[n] else '(o)'
+                out.append(f'{n + 1}. {online_marker} {name} - {rating}')
             out.append(SEPARATOR)
-            if self._last_game:
-                out.append(self._last_game)
+            if state.last_game:
+                out.append(state.last_game)
                 out.append(SEPARATOR)
             out.append(
-                f'online: {len(self._online_users)} / offline: {len(self._all_users) - len(self._online_users)}')
+                f'online: {len(state.online_users)} / offline: {state.count_offline_users()}')
             out.append('online: (*) / offline: (o)')
-            return '\n'.join(out)
+            self.__rating_chart = (key, '\n'.join(out))
+            return self.__rating_chart[1]
 
-        def get_users(_) -> str:
+        def get_users(args: list) -> str:
             out = list()
-            if self._online_users:
+            if state.online_users:
                 out.append('online:')
-                for user in self._online_users:
+                for user in state.online_users:
                     out.append(str(user))
-                out.append(f'#online:{str(len(self._online_users))}')
+                out.append(f'#online:{str(len(state.online_users))}')
             else:
                 out.append('no users online')
             out.append(SEPARATOR)
-            offline_users = self._all_users - self._online_users
+            page = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 1
+            users = self._read(lambda db: db.get_page((page - 1) * Server.PAGE_SIZE, Server.PAGE_SIZE))
+            users = [state.users_by_name.get(user.get_name(), user) for user in users]
+            offline_users = [user for user in users if user not in state.online_users]
             if offline_users:
-                out.append('offline:')
+                out.append(f'offline (page {page}):')
                 for user in offline_users:
                     out.append(str(user))
-                out.append('#offline:' + str(len(offline_users)))
+                out.append(f'#offline:{state.count_offline_users()}')
+                if len(users) == Server.PAGE_SIZE:  # else this is the last page
+                    out.append(f'next page: get {page + 1}')
             else:
-                out.append('no users offline')
+                out.append('no users offline' if page == 1 else f'no users offline on page {page}')
             return '\n'.join(out)
 
         def get_threads(_) -> str:
@@ -258,7 +473,7 @@ class Server:
         def get_ip_addresses(_) -> str:
             out = list()
             user_count = 0
-            for item in self._ip_addresses.items():
+            for item in state.ip_addresses.items():
                 user_count += item[1]
                 out.append(str(item))
             out.append('TOTAL: ' + str(user_count))
@@ -266,15 +481,25 @@ class Server:
 
         def get_links(_) -> str:
             out = list()
-            for user_item in self._linked_users.items():
+            for user_item in state.linked_users.items():
                 out.append(str(user_item[0]) + ' <-> ' + str(user_item[1]))
-            self._unlinked_users.clear()
-            self._unlinked_users.update(self._online_users - set(self._linked_users))
-            if self._unlinked_users:
+            unlinked_users = [user for user in state.online_users if user not in state.linked_users]
+            if unlinked_users:
                 out.append('unlinked:')
-                for user in self._unlinked_users:
+                for user in unlinked_users:
                     out.append(str(user))
-            out.append('linked: {} / unlinked: {}'.format(len(self._linked_users), len(self._unlinked_users)))
+            out.append('linked: {} / unlinked: {}'.format(len(state.linked_users), len(unlinked_users)))
+            return '\n'.join(out)
+
+        def get_queues(args: list) -> str:
+            count = int(args[0]) if args and args[0].isdigit() else 10
+            out = [self._get_inbox_info(state.online_users)]
+            backlog = [(len(user.messages or ()), user.get_name()) for user in state.online_users]
+            backlog.sort(reverse=True)
+            for queued, name in backlog[:count]:
+                if not queued:
+                    break
+                out.append(f'{name}: {queued}')
             return '\n'.join(out)
 
         def stop(_) -> str:
@@ -285,6 +510,39 @@ class Server:
             os.system('shutdown -h 0')
             return 'shut server down immediately'
 
+        def get_metrics(_) -> str:
+            return self.metrics.get_info()
+
+        def profile(args: list) -> str:
+            action = args[0] if args else ''
+            if action == 'start':
+                if self.__sampler:
+                    return 'profiler already running - profile stop'
+                self.__sampler = Sampler(f'{self.SOCKET_NAME} profiler')
+                self.__sampler.start()
+                return 'profiler started - profile stop writes the results'
+            if action == 'stop':
+                if not self.__sampler:
+                    return 'profiler not running - profile start'
+                sampler, self.__sampler = self.__sampler, None
+                sampler.stop()
+                file_name = f'{self.DATA_DIR}/profile-{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.txt'
+                sampler.write(file_name)
+                return f'{sampler.get_summary()}\nstacks written to {file_name}'
+            return 'profile start|stop'
+
+        def memory_snapshot(args: list) -> str:
+            if args and args[0] == 'stop':
+                tracemalloc.stop()
+                self.__memory_snapshot = None
+                return 'stopped tracing allocations'
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                return 'tracing allocations - memsnap writes a snapshot, memsnap stop ends the tracing'
+            file_name = f'{self.DATA_DIR}/memsnap-{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.tracemalloc'
+            self.__memory_snapshot, summary = take_memory_snapshot(file_name, self.__memory_snapshot)
+            return f'{summary}\nsnapshot written to {file_name}'
+
         commands = {
             'feedback': fetch_feedback,
             'get': get_users,
@@ -292,9 +550,13 @@ class Server:
             'ip': get_ip_addresses,
             'links': get_links,
             'list': get_threads,
+            'memsnap': memory_snapshot,
+            'metrics': get_metrics,
             'notify': notify_user,
             'notify_all': notify_all,
+            'profile': profile,
             'rating': get_rating_chart,
+            'queues': get_queues,
             'resetpw': reset_password,
             'remove': remove_user,
             'setlang': set_language,
@@ -317,341 +579,761 @@ class Server:
             return f'{SEPARATOR_LF}{notification}#####\n{SEPARATOR_LF}'
 
     def _get_user_by_name(self, name: str) -> T_User:
-        for user in self._all_users:
-            if name == user.get_name():
-                return user
-        return None
+        user = self._users_by_name.get(name)
+        if user:
+            self.__touch_offline_user(name)
+            return user
+
+        return self._cache_user(name, self._read(lambda db: db.get_user(name)))
+
+    def _cache_user(self, name: str, stored: T_User) -> T_User:
+        # returns the user in memory or keeps the user read from the database in memory
+        user = self._users_by_name.get(name)
+        if user:
+            self.__touch_offline_user(name)
+            return user
+        if not stored or self._persistence.is_pending(stored.get_id()):
+            return None  # unknown or removed but not yet deleted from the database
+        self._all_users.add(stored)
+        self._users_by_name[name] = stored
+        self.__cache_offline_user(stored)
+        return stored
+
+    def _take_snapshot(self, copy: bool = True) -> Snapshot:
+        # runs on the main loop. copy False returns the live state, for a command which runs on the main loop too
+        take = (lambda collection: collection.copy()) if copy else (lambda collection: collection)
+        return Snapshot(take(self._online_users), take(self._online_users_by_name), take(self._users_by_name),
+                        take(self._linked_users), take(self._ip_addresses), self._registered_users,
+                        len(self._all_users), self._last_game)
+
+    def _admin_command(self, command: str, reply: T_Reply) -> None:
+        # runs on the main loop. a command which changes the state runs at once, the others run on the admin worker
+        # against a snapshot, so a slow command does not hold up the games. reply may be called by the admin worker
+        arguments = command.split(maxsplit=1)
+        snapshot = None if not arguments or arguments[0] in Server.LOOP_COMMANDS else self._take_snapshot()
+
+        def run():
+            try:
+                output = self.execute(command, snapshot)
+            except Exception as ex:
+                logging.error(f'ERROR ADMIN COMMAND {command} - {str(ex)}')
+                output = f'ERROR: {str(ex)}'
+            reply(output)
+
+        if snapshot is None:
+            run()
+        else:
+            self._admin_worker.submit(run)
+
+    def _forget_user(self, name: str) -> None:
+        # drops an offline user from memory, e.g. after another process has changed the database row
+        user = self._offline_users.get(name)
+        if user and not user.dirty and not self._persistence.is_pending(user.get_id()):
+            self._offline_users.pop(name)
+            self._all_users.discard(user)
+            self._users_by_name.pop(name, None)
+
+    def _read(self, query: typing.Callable[[Database], typing.Any]) -> typing.Any:
+        with self._reader_lock:
+            return query(self._reader)
+
+    def __touch_offline_user(self, name: str) -> None:
+        # the least recently used offline users are dropped first, see __cache_offline_user
+        if name in self._offline_users:
+            self._offline_users.move_to_end(name)
+
+    def __cache_offline_user(self, user: User) -> None:
+        # keeps at most USER_CACHE_SIZE offline users in memory
+        self._offline_users[user.get_name()] = user
+        self._offline_users.move_to_end(user.get_name())
+        overflow = len(self._offline_users) - Server.USER_CACHE_SIZE
+        if overflow <= 0:
+            return
+        # users with unsaved changes stay until the database is up to date:
+        for old_user in list(islice(self._offline_users.values(), overflow + Server.PAGE_SIZE)):
+            if old_user.dirty or self._persistence.is_pending(old_user.get_id()):
+                continue
+            self._offline_users.pop(old_user.get_name())
+            self._all_users.discard(old_user)
+            self._users_by_name.pop(old_user.get_name(), None)
+            overflow -= 1
+            if overflow <= 0:
+                break
 
     def _get_online_user_by_name(self, name: str) -> T_User:
-        for user in self._online_users:
-            if user.get_name() == name:
-                return user
-        return None
+        return self._online_users_by_name.get(name)
 
-    def __manage_user_requests(self):
-        self.__server_socket.settimeout(Server.TIMEOUT)
-        self.__server_socket.listen(Server.BACKLOG)
-        last_db_update = time.time()
+    def _set_users_online(self, users: typing.Iterable[User]) -> None:
+        self._online_users.update(users)
+        for user in users:
+            self._online_users_by_name[user.get_name()] = user
+            self._offline_users.pop(user.get_name(), None)
+            self.__schedule_heartbeat(user, user.last_received + Server.HEARTBEAT_INTERVAL)
 
-        while not self._stop:
+    def __schedule_heartbeat(self, user: User, due: float) -> None:
+        if Server.IDLE_TIMEOUT is None:
+            return
+        self.__heartbeat_due[user] = due
+        heapq.heappush(self.__heartbeats, (due, user.get_id(), user))
+
+    def _reap_idle_users(self, now: float) -> None:
+        # sends %ECHO? to users who were idle for HEARTBEAT_INTERVAL and signs off users who were idle for
+        # IDLE_TIMEOUT, e.g. of a half-open connection. only the users whose check is due are looked at
+        reaped = list()
+        while self.__heartbeats and self.__heartbeats[0][0] <= now:
+            due, _, user = heapq.heappop(self.__heartbeats)
+            if self.__heartbeat_due.get(user) != due:
+                continue  # offline or rescheduled
+            idle = now - user.last_received
+            if idle >= Server.IDLE_TIMEOUT:
+                logging.info(f'{user.get_name()} sent nothing for {idle:.0f}s - signed off')
+                reaped.append((user, user.socket))
+                self._disconnected_users.add(user)
+            elif idle >= Server.HEARTBEAT_INTERVAL:
+                self._notify(user, '%ECHO?')
+                self._heartbeats_sent.inc()
+                self.__schedule_heartbeat(user, user.last_received + Server.IDLE_TIMEOUT)
+            else:
+                self.__schedule_heartbeat(user, user.last_received + Server.HEARTBEAT_INTERVAL)
+        if reaped:
+            self._reaped.inc(len(reaped))
+            self._remove_disconnected_users()
+            for _, skt in reaped:
+                skt.close()  # after it is unselected
 
-            if time.time() - last_db_update > Server.DB_UPDATE_INTERVAL:
-                logging.info(self.execute('update'))  # database update
-                last_db_update = time.time()
+    def __manage_user_requests(self):
+        self._server_socket.settimeout(Server.TIMEOUT)
+        self._server_socket.listen(Server.BACKLOG)
+        # admittances run concurrently, so a slow client does not hold up other logins:
+        handshakes = ThreadPoolExecutor(max_workers=Server.HANDSHAKE_WORKERS,
+                                        thread_name_prefix=f'{self.SOCKET_NAME} handshake')
 
+        while not self._stop:
             logging.debug('listening...')
             try:
-                skt, _address = self.__server_socket.accept()
+                skt, _address = self._server_socket.accept()
             except timeout:
                 logging.debug('server socket timeout')
                 continue
 
             ip = _address[0]
+            if self._over_accept_limit(ip) or self.__over_handshake_limit(ip):
+                self._reset_on_close(skt)
+                skt.close()
+                continue
             address = str(_address)
             logging.info(f'connected to {str(address)}')
+            skt.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)  # messages are coalesced by User.queue
 
-            new_user = User(skt, ip)
-            new_user.set_timeout(0.9)
-            try:
-                authentication = new_user.next_message()
-
-                if authentication == self.__admin_authentication:
-                    if self._admin:
-                        self._admin.notify('ERROR: ADMIN SIGNED IN TWICE')
-                        self._admin.socket.close()
-                    self._admin = new_user
-                    self._admin.set_name('admin')
-                    self._admin.set_timeout(0)
-                    self._admin.notify(f'database:\n{self.DATABASE_FILENAME}\nprogram version:{PROGRAM_VERSION}')
-                    logging.info('admin connected')
-                    continue
-
-                if not authentication == self.__authentication:
-                    new_user.error(string(AUTH_ERROR))
-                    continue
-
-                user_name = new_user.next_message()
-                if not user_name.startswith('%NAME '):
-                    new_user.error(string(PROTOCOL_ERROR))
-                    continue
-                else:
-                    try:
-                        user_name = user_name.split(maxsplit=1)[1]
-                    except IndexError:
-                        new_user.error(string(PROTOCOL_ERROR))
-                        continue
-
-                known_user: T_User = self._get_user_by_name(user_name)
-
-                if known_user:
+            new_user = User(skt, ip)  # takes an id once it is admitted, see _admit
+            handshakes.submit(self.__handshake, new_user, time.time())
 
-                    if known_user in self._online_users:
-                        new_user.error(string(ALREADY_ASSIGNED).format(user_name))
-                        continue
-
-                    user_password = new_user.next_message()
-                    if known_user.get_password() == '%RESET_PASSWORD':
-                        known_user.set_password(user_password)
-                    elif user_password != known_user.get_password():
-                        new_user.error(string(INCORRECT_PW))
-                        continue
-
-                    known_user.renew_connection(skt, ip, datetime.now().strftime('%Y.%m.%d.%H:%M:%S'))
-                    new_user = known_user
-
-                else:
-                    user_password = new_user.next_message()
-                    new_user.set_password(user_password)
-                    new_user.set_name(user_name)
+        handshakes.shutdown(wait=True)
+        logging.info(f'{self.SOCKET_NAME} request manager interrupted')
 
-                new_user.notify('WELCOME ' + user_name)
+    def __over_handshake_limit(self, ip: str) -> bool:
+        # is called by the thread which accepts the connections. counts the admittance if it is within the limits
+        prefix = AcceptLimiter.get_prefix(ip)
+        with self.__handshakes_lock:
+            if self.__handshake_count >= Server.MAX_HANDSHAKES:
+                limit = 'handshakes'
+            elif self.__handshakes.get(ip, 0) >= Server.HANDSHAKES_PER_IP:
+                limit = 'handshake_ip'
+            elif self.__handshakes.get(prefix, 0) >= Server.HANDSHAKES_PER_PREFIX:
+                limit = 'handshake_prefix'
+            else:
+                for key in (ip, prefix):
+                    self.__handshakes[key] = self.__handshakes.get(key, 0) + 1
+                self.__handshake_count += 1
+                return False
+        self._refused[limit].inc()
+        logging.debug(f'refused {ip} - {limit} limit')
+        return True
+
+    def __handshake(self, new_user: User, accepted: float) -> None:
+        try:
+            self.__admit_connection(new_user, accepted)
+        finally:
+            with self.__handshakes_lock:
+                for key in (new_user.ip, AcceptLimiter.get_prefix(new_user.ip)):
+                    count = self.__handshakes.pop(key) - 1
+                    if count:
+                        self.__handshakes[key] = count
+                self.__handshake_count -= 1
+
+    def __admit_connection(self, new_user: User, accepted: float) -> None:
+        skt = new_user.socket
+        deadline = accepted + Server.HANDSHAKE_TIMEOUT
+        frames = [0]  # read by the admittance, the main loop counts them like the frames of the online users
+
+        def next_message() -> str:
+            new_user.set_timeout(max(deadline - time.time(), 0.001))
+            message = new_user.next_message()
+            if message:
+                frames[0] += 1
+            return message
 
-            except timeout:
-                try:
-                    new_user.error(string(TIMEOUT_ERROR))
-                except OSError:
-                    pass
-                logging.info('TIMEOUT ERROR (ADMITTANCE)')
-                continue
-            except ConnectionError:
-                logging.info('CONNECTION ERROR (ADMITTANCE)')
-                skt.close()
-                continue
-            except OSError as ex:
-                logging.error('OS ERROR (ADMITTANCE)')
-                logging.error(str(ex))
-                skt.close()
-                continue
-            except Exception as ex:
-                logging.error(str(ex))
+        try:
+            authentication = next_message()
+
+            if self._is_admin(authentication):
+                new_user.set_timeout(0)
+                self._post(lambda: self._set_admin(new_user))
+                return
+
+            if not self._is_authenticated(authentication):
+                new_user.error(string(AUTH_ERROR))
+                return
+
+            user_name = self._parse_name(next_message())
+            if not user_name:
+                new_user.error(string(PROTOCOL_ERROR))
+                return
+
+            user_password = next_message()
+            # the database is read here, so the main loop does not wait for it. a user in memory takes precedence
+            self.__loaded.wait()  # e.g. while the journal is replayed after a restart
+            if self._stop:
                 skt.close()
-                continue
-
-            logging.info(f'{user_name} has connected')
+                return
+            stored = self._read(lambda db: db.get_user(user_name))
+            self.__arrivals.append((new_user, user_name, user_password, stored, accepted))
+            self.__wakeup()
 
-            if Server.MAX_PER_IP <= self._ip_addresses.setdefault(new_user.ip, 0):
-                new_user.error(string(TOO_MANY_IP))
-                continue
+        except timeout:
+            try:
+                new_user.error(string(TIMEOUT_ERROR))
+            except OSError:
+                pass
+            logging.info('TIMEOUT ERROR (ADMITTANCE)')
+            return
+        except ConnectionError:
+            logging.info('CONNECTION ERROR (ADMITTANCE)')
+            skt.close()
+            return
+        except OSError as ex:
+            logging.error('OS ERROR (ADMITTANCE)')
+            logging.error(str(ex))
+            skt.close()
+            return
+        except Exception as ex:
+            logging.error(str(ex))
+            skt.close()
+            return
+        finally:
+            if frames[0]:
+                self._post(lambda: self._frames_in.inc(frames[0]))
+
+    def _over_accept_limit(self, ip: str) -> bool:
+        # is called by the thread which accepts the connections
+        limit = self._accept_limiter.check(ip, time.time())
+        if not limit:
+            self._accepted.inc()
+            return False
+        self._refused[limit].inc()
+        logging.debug(f'refused {ip} - {limit} accept rate limit')
+        return True
+
+    @staticmethod
+    def _reset_on_close(skt: typing.Any) -> None:
+        # a refused connection is reset, so it does not remain in TIME_WAIT
+        try:
+            skt.setsockopt(SOL_SOCKET, SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
 
-            self._lock.acquire(True)
-            self.register_user(new_user)
-            new_user.set_timeout(0)
-            self._lock.release()
+    def _is_admin(self, authentication: str) -> bool:
+        return authentication == self.__admin_authentication
 
-        logging.info(f'{self.SOCKET_NAME} request manager interrupted')
+    def _is_authenticated(self, authentication: str) -> bool:
+        return authentication == self.__authentication
 
-    def __administrate(self):
+    @staticmethod
+    def _parse_name(message: str) -> str:
+        # returns the name of a '%NAME *name*' message or an empty string in case of a protocol error
+        if not message.startswith('%NAME '):
+            return ''
+        try:
+            return message.split(maxsplit=1)[1]
+        except IndexError:
+            return ''
+
+    def _admit(self, new_user: User, user_name: str, user_password: str,
+               known_user: T_User) -> typing.Tuple[T_User, str]:
+        # returns the admitted user or None and an error message. runs on the main loop like register_user
+        if self._too_many_users(new_user.ip):
+            return None, string(TOO_MANY_IP)
+
+        if known_user:
+            if known_user in self._online_users:
+                return None, string(ALREADY_ASSIGNED).format(user_name)
+            if known_user.get_password() == '%RESET_PASSWORD':
+                known_user.set_password(user_password)
+            elif user_password != known_user.get_password():
+                return None, string(INCORRECT_PW)
+            known_user.renew_connection(new_user.socket, new_user.ip, time.time())
+            known_user.take_buffer(new_user)
+            return known_user, ''
+
+        new_user.assign_id()
+        new_user.set_password(user_password)
+        new_user.set_name(user_name)
+        return new_user, ''
+
+    def _set_admin(self, new_admin: User) -> None:
+        if self._admin:
+            self._admin.notify('ERROR: ADMIN SIGNED IN TWICE')
+            self._admin.socket.close()
+        self._admin = new_admin
+        self._admin.set_name('admin')
+        self._admin.on_pending = self.__schedule_flush
+        self._admin.notify(f'database:\n{self.DATABASE_FILENAME}\nprogram version:{PROGRAM_VERSION}')
+        logging.info('admin connected')
+
+    def _too_many_users(self, ip: str) -> bool:
+        return Server.MAX_PER_IP <= self._ip_addresses.get(ip, 0)
+
+    def _administrate(self):
         while not self._stop:
-            command = input()
-            print(self.execute(command))
+            try:
+                command = input()
+            except EOFError:
+                break  # no console, e.g. started in the background
+            reply: Future = Future()
+            self._post(lambda: self._admin_command(command, reply.set_result))
+            print(reply.result())
         logging.info(f'{self.SOCKET_NAME} administrator interrupted')
 
     def __add_ip(self, ip):
-        # is called in a locked context
+        # is called on the main loop
         if ip in self._ip_addresses:
             self._ip_addresses[ip] += 1
         else:
             self._ip_addresses.update({ip: 1})
 
     def __discard_ip(self, ip):
-        self._lock.acquire(True)  # block
         if ip in self._ip_addresses:
             self._ip_addresses[ip] -= 1
         else:
             # will not happen...
             logging.error('mismatch: {} not stored in ip_addresses'.format(ip))
-            self._lock.release()
             return
         if self._ip_addresses[ip] == 0:
             self._ip_addresses.pop(ip)
-        self._lock.release()
 
-    def __remove_disconnected_users(self):
+    def _remove_disconnected_users(self):
         self._online_users.difference_update(self._disconnected_users)
         for user in self._disconnected_users:
             self.__set_user_offline(user)
         self._disconnected_users.clear()
 
     def __set_user_offline(self, user: User):
+        if self._online_users_by_name.get(user.get_name()) is user:
+            self._online_users_by_name.pop(user.get_name())
+        if self._users_by_name.get(user.get_name()) is user:
+            self.__cache_offline_user(user)
+        user.release_connection()
+        self.__unselect(user)
+        self.__unflushed.discard(user)
+        self.__heartbeat_due.pop(user, None)
         self.__discard_ip(user.ip)
         logging.info(f'{user.get_name()} left')
+        self._on_user_offline(user)
         if user in self._users_to_link:
             self._users_to_link.remove(user)
+            self._matchmaker.remove(user)
         if user in self._linked_users:
+            self._end_game(user, self._linked_users[user])
             self._linked_users.pop(self._linked_users[user])
             self._linked_users.pop(user)
 
-    def __add_users(self):
-        # the user_wait_loop makes sure the request manager thread can add users while other threads run
-        if self._lock.acquire(False):  # non blocking
-            self._online_users.update(self._user_wait_loop)
-            self._user_wait_loop.clear()
-            self._lock.release()
-        else:
-            logging.info('thread is locked - did not add users')
+    def _on_user_offline(self, user: User) -> None:
+        pass  # called before the user is removed from the waiting and linked users
+
+    def __add_users(self) -> None:
+        # admits the users whose handshake is done. the handshake threads only append to __arrivals and the main
+        # loop is its only consumer (deque.append and popleft are atomic), so neither side waits for a lock
+        for _ in range(len(self.__arrivals)):
+            new_user, user_name, user_password, stored, accepted = self.__arrivals.popleft()
+            admitted_user, error = self._admit(new_user, user_name, user_password, self._cache_user(user_name, stored))
+            if not admitted_user:
+                new_user.error(error)
+                continue
+            admitted_user.set_timeout(0)
+            self._notify(admitted_user, 'WELCOME ' + user_name)
+            self.register_user(admitted_user)
+            self.__select(admitted_user)
+            frames = admitted_user.collect_messages()  # sent right after the password
+            if frames:
+                self._frames_in.inc(frames)
+                self.__messages_pending = True
+            self._handshake_seconds.observe(time.time() - accepted)
+            logging.info(f'{user_name} has connected')
 
-    def __process_messages(self) -> None:
-        user_a: User
-        originator: User
-        for originator in self._online_users:
-            if originator.messages:
-                msg = originator.messages.pop(0)
-                logging.debug(f'{originator.get_name()}:{msg}')
-            else:
+    def __wakeup(self) -> None:
+        # interrupts the select call of the main loop
+        try:
+            self._wakeup_sender.send(b'\0')
+        except BlockingIOError:
+            pass  # wakeup already pending
+        except OSError as ex:
+            logging.debug(str(ex))
+
+    def __drain_wakeup(self) -> None:
+        try:
+            while self._wakeup_receiver.recv(BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __select(self, user: User) -> None:
+        try:
+            self._selector.register(user.socket, selectors.EVENT_READ, user)
+        except (KeyError, ValueError, OSError) as ex:
+            logging.error(f'could not select {user.get_name()} - {str(ex)}')
+
+    def __select_for_writing(self, user: User, writing: bool) -> None:
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+        try:
+            if self._selector.get_key(user.socket).events != events:
+                self._selector.modify(user.socket, events, user)
+        except (KeyError, ValueError, OSError):
+            pass  # not selected, e.g. the user has left
+
+    def _post(self, callback: typing.Callable[[], None]) -> None:
+        # runs the callback on the main loop, which owns the user state
+        self.__posted.append(callback)
+        self.__wakeup()
+
+    def __run_posted(self) -> None:
+        for _ in range(len(self.__posted)):
+            callback = self.__posted.popleft()
+            try:
+                callback()
+            except Exception as ex:
+                logging.error(str(ex))
+
+    def __schedule_flush(self, user: User) -> None:
+        # the socket of the user did not take all queued output - the main loop writes the rest
+        self.__unflushed.add(user)
+        self.__wakeup()
+
+    def __flush_users(self) -> None:
+        # writes the output queued in this cycle. users whose socket is full are selected for writing
+        for user in list(self.__unflushed):
+            try:
+                flushed = user.flush()
+            except (ConnectionError, OSError) as ex:
+                logging.info(f'CONNECTION ERROR (SENDING DATA TO {user.get_name()}) {str(ex)}')
+                self.__drop_receiver(user)
+                continue
+            if flushed:
+                self.__unflushed.discard(user)
+            elif user.pending_output() > User.HIGH_WATER_MARK:
+                logging.info(f'{user.get_name()} does not receive its messages - disconnected')
+                self.__drop_receiver(user)
                 continue
+            self.__select_for_writing(user, not flushed)
+
+    def __drop_receiver(self, user: User) -> None:
+        self.__unflushed.discard(user)
+        if user is self._admin:
+            self.__unselect(user)
+            user.socket.close()
+            self._admin = None
+        elif user in self._online_users:
+            self._disconnected_users.add(user)
+
+    def _notify(self, user: User, *messages: str) -> None:
+        # queues the messages, they are sent together at the end of the main loop cycle
+        self._frames_out.inc(len(messages))
+        self._bytes_out.inc(user.queue(*messages))
+        self.__unflushed.add(user)
+
+    def __unselect(self, user: User) -> None:
+        try:
+            self._selector.unregister(user.socket)
+        except (KeyError, ValueError):
+            pass  # socket was never selected or has already been unregistered
+
+    def __select_admin(self) -> None:
+        # the request manager replaces the admin - keep the selector in sync
+        if self._admin is not self.__selected_admin:
+            if self.__selected_admin:
+                self.__unselect(self.__selected_admin)
+            if self._admin:
+                self.__select(self._admin)
+                if self._admin.collect_messages():
+                    self.__messages_pending = True
+            self.__selected_admin = self._admin
 
-            if msg.startswith('%SERVER'):
-                user_a = originator
-
-                def link():
-                    if user_a not in self._linked_users:
-                        self._users_to_link.add(user_a)
-                        user_a.notify('%NOTE {}'.format(string(WAIT_FOR_PLAYER)))
-
-                def link_to(username: str):
-                    user_b: T_User = self._get_online_user_by_name(username)
-                    if user_b and user_b not in self._linked_users:
-                        self.__link_users(user_a, user_b)
-
-                def feedback(text: str):
-                    date = datetime.now().strftime('d%m-%dt%H-%M-%S')
-                    file_name = 'feedback-{}-{}.txt'.format(date, user_a.get_name())
-                    full_path_name = f'{self.DATA_DIR}/{file_name}'
-                    f = open(full_path_name, 'w')
-                    f.write(text)
-                    f.close()
-
-                def get_elo_rating():
-                    output = '%ELO [ {} - {} ]\n'.format(user_a.get_name(), user_a.rating)
-                    output += self.execute('rating')
-                    user_a.notify(output)
-
-                def disconnect():
-                    self._disconnected_users.add(user_a)
-
-                def update_rating(scoring: str):
-                    user_b: User
-                    scoring = float(scoring)
-                    if user_a in self._linked_users:
-                        user_b = self._linked_users.get(user_a)
-                        a = user_a.rating
-                        b = user_b.rating
-                        elo_weight = min(user_a.get_elo_weight(), user_b.get_elo_weight())
-                        a_rating = elo_rating(a, b, scoring, elo_weight)
-                        b_rating = elo_rating(b, a, 1.0 - scoring, elo_weight)
-                        logging.info('update rating:\n{}: {} -> {}\n{}: {} -> {}'.format(
-                            user_a.get_name(),
-                            a, a_rating,
-                            user_b.get_name(),
-                            b, b_rating
-                        ))
-                        user_a.rating = a_rating
-                        user_b.rating = b_rating
-                        user_a.dec_elo_weight()
-                        user_b.dec_elo_weight()
-                        self._linked_users.pop(user_a)
-                        self._linked_users.pop(user_b)
-                        user_a.played_games += 1
-                        user_b.played_games += 1
-                        if scoring == 0.0:
-                            user_a.scoring_zero += 1
-                            user_b.scoring_one += 1
-                        elif scoring == 1.0:
-                            user_a.scoring_one += 1
-                            user_b.scoring_zero += 1
-                        else:
-                            user_a.scoring_half += 1
-                            user_b.scoring_half += 1
-
-                        date = datetime.now().strftime('%d.%m.')
-                        if scoring == 1.0:
-                            self._last_game = f'{user_a.get_name()} - {user_b.get_name()} 1:0 ({date})'
-                        elif scoring == 0.0:
-                            self._last_game = f'{user_a.get_name()} - {user_b.get_name()} 0:1 ({date})'
-                        elif scoring == 0.5:
-                            self._last_game = f'{user_a.get_name()} - {user_b.get_name()} 1/2:1/2 ({date})'
-
-                commands = {
-                    'LINK': link,
-                    'LINKTO': link_to,
-                    'FEEDBACK': feedback,
-                    'ELO': get_elo_rating,
-                    'SCORING': update_rating,
-                    'DISCONNECT': disconnect,
-                }
-
-                arguments = msg.split(maxsplit=2)
-                if not arguments:
-                    logging.info(f'{msg} - no arguments')
-                else:
-                    try:
-                        command = arguments[1]
-                        if command in commands:
-                            if len(arguments) == 3:
-                                commands.get(command)(arguments[2])
-                            elif len(arguments) == 2:
-                                commands.get(command)()
+    def __receive(self, user: User) -> None:
+        if user is self._admin:
+            try:
+                user.receive_messages()
+            except BlockingIOError:
+                pass
+            except ConnectionError:
+                logging.info('CONNECTION ERROR (RECEIVING DATA FROM ADMIN)')
+                self.__unselect(user)
+                user.socket.close()
+                self._admin = None
+            except OSError as ex:
+                logging.error('OS ERROR (RECEIVING DATA FROM ADMIN)')
+                logging.error(str(ex))
+                self.__unselect(user)
+                user.socket.close()
+                self._admin = None
+            return
 
-                    except IndexError:
-                        logging.info('index error')
+        if user not in self._online_users:
+            self.__unselect(user)  # stale registration, e.g. a replaced admin
+            return
+        if len(user.messages) >= Server.INBOX_LIMIT:
+            return  # the client has to wait until its queued messages are handled
 
-            else:
-                recipient = None
-                if originator in self._linked_users:
-                    recipient = self._linked_users[originator]
-
-                if recipient:
-                    try:
-                        recipient.notify(msg)
-                    except ConnectionError:
-                        logging.info('CONNECTION ERROR (NOTIFY ' + recipient.get_name() + ')')
-                        self._disconnected_users.add(recipient)
-                        continue
-                    except OSError:
-                        logging.info('OS ERROR (NOTIFY ' + recipient.get_name() + ')')
-                        traceback.print_exc()
-                        self._disconnected_users.add(recipient)
-                        continue
-                    except Exception as ex:
-                        logging.error(str(ex))
-                else:
-                    try:
-                        originator.notify('%NOTE ' + string(NOT_LINKED))
-                    except ConnectionError:
-                        logging.info('CONNECTION ERROR (NOTIFY ' + originator.get_name() + ')')
-                        self._disconnected_users.add(originator)
-                        continue
-                    except OSError as ex:
-                        logging.error('OS ERROR (NOTIFY ' + originator.get_name() + ')')
-                        logging.error(str(ex))
-                        self._disconnected_users.add(originator)
-                        continue
-                    except Exception as ex:
-                        logging.error(str(ex))
+        try:
+            received, frames = user.receive_messages()
+            user.last_received = time.time()
+            self._bytes_in.inc(received)
+            self._frames_in.inc(frames)
+        except BlockingIOError:
+            pass
+        except ConnectionError as ex:
+            # e.g. closed by the peer or a message longer than FrameBuffer.MAX_FRAME
+            logging.info(f'CONNECTION ERROR (RECEIVING DATA FROM {user.get_name()}) {str(ex)}')
+            skt = user.socket
+            self._disconnected_users.add(user)
+            self._remove_disconnected_users()
+            skt.close()  # after it is unselected
+        except OSError:
+            logging.info('OS ERROR (RECEIVING DATA FROM ' + user.get_name() + ')')
+            self._disconnected_users.add(user)
+            traceback.print_exc()
+        except Exception as ex:
+            logging.error(str(ex))
+
+    def __process_messages(self) -> bool:
+        # handles up to MESSAGE_BUDGET messages per user and returns True if messages are left
+        user_a: User
+        originator: User
+        pending = False
+        for originator in list(self._online_users):
+            inbox = originator.messages
+            self.__peak_inbox = max(self.__peak_inbox, len(inbox))
+            for _ in range(min(len(inbox), Server.MESSAGE_BUDGET)):
+                if originator in self._disconnected_users:
+                    break
+                msg = inbox.popleft()
+                logging.debug(f'{originator.get_name()}:{msg}')
+                try:
+                    self._process_message(originator, msg)
+                except Exception as ex:
+                    logging.error(str(ex))  # e.g. %SERVER SCORING x, the other users go on
+            pending = pending or bool(inbox)
 
         if self._admin:
             if self._admin.messages:
-                cmd = self._admin.messages.pop(0)
+                admin = self._admin
+                # the reply comes back to the main loop, also from the admin worker:
+                self._admin_command(admin.messages.popleft(),
+                                    lambda output: self._post(lambda: self.__reply_admin(admin, output)))
+            if self._admin and self._admin.messages:
+                pending = True
+
+        return pending
+
+    def __reply_admin(self, admin: User, output: str) -> None:
+        if admin is not self._admin:
+            return  # signed off or replaced meanwhile
+        try:
+            admin.notify(output)
+        except ConnectionError:
+            logging.info('CONNECTION ERROR (NOTIFY ADMIN)')
+            admin.socket.close()
+            self._admin = None
+        except OSError as ex:
+            logging.error('OS ERROR (NOTIFY ADMIN)')
+            logging.error(str(ex))
+            admin.socket.close()
+            self._admin = None
+
+    def _get_inbox_info(self, online_users: typing.Collection[User]) -> str:
+        queued = sum(len(user.messages or ()) for user in online_users)  # released if the user has left meanwhile
+        return f'inbox: queued {queued} / peak {self.__peak_inbox} (budget {Server.MESSAGE_BUDGET})'
+
+    def _process_message(self, originator: User, msg: str) -> None:
+        user_a: User
+        if msg.startswith('%ECHO'):
+            return  # the answer to a heartbeat, see _reap_idle_users
+        if msg.startswith('%SERVER'):
+            user_a = originator
+
+            def link():
+                if user_a not in self._linked_users and user_a not in self._users_to_link:
+                    self._users_to_link.add(user_a)
+                    self._notify(user_a, '%NOTE {}'.format(string(WAIT_FOR_PLAYER)))
+                    self._request_link(user_a)
+
+            def link_to(username: str):
+                self._request_link_to(user_a, username)
+
+            def feedback(text: str):
+                self._feedback.add(user_a.get_name(), text)
+
+            def get_elo_rating():
+                output = '%ELO [ {} - {} ]\n'.format(user_a.get_name(), user_a.rating)
+                output += self.execute('rating')
+                rank = self._leaderboard.rank(user_a.get_id())
+                if rank and rank > 10:
+                    output += f'\n{rank}. (*) {user_a.get_name()} - {user_a.rating}'
+                self._notify(user_a, output)
+
+            def disconnect():
+                self._disconnected_users.add(user_a)
+
+            def update_rating(scoring: str):
+                user_b: User
+                scoring = float(scoring)
+                if scoring not in RESULTS:
+                    logging.info(f'SCORING {scoring} - 0, 0.5 or 1 expected')
+                    return
+                if user_a in self._linked_users:
+                    user_b = self._linked_users.get(user_a)
+                    a = user_a.rating
+                    b = user_b.rating
+                    elo_weight = min(user_a.get_elo_weight(), user_b.get_elo_weight())
+                    a_rating = elo_rating(a, b, scoring, elo_weight)
+                    b_rating = elo_rating(b, a, 1.0 - scoring, elo_weight)
+                    logging.info('update rating:\n{}: {} -> {}\n{}: {} -> {}'.format(
+                        user_a.get_name(),
+                        a, a_rating,
+                        user_b.get_name(),
+                        b, b_rating
+                    ))
+                    user_a.add_result(a_rating, scoring)
+                    user_b.add_result(b_rating, 1.0 - scoring)
+                    self._rating_changed(user_a)
+                    self._rating_changed(user_b)
+                    self._end_game(user_a, user_b, scoring)
+                    self._linked_users.pop(user_a)
+                    self._linked_users.pop(user_b)
+
+                    date = datetime.now().strftime('%d.%m.')
+                    if scoring == 1.0:
+                        self._last_game = f'{user_a.get_name()} - {user_b.get_name()} 1:0 ({date})'
+                    elif scoring == 0.0:
+                        self._last_game = f'{user_a.get_name()} - {user_b.get_name()} 0:1 ({date})'
+                    elif scoring == 0.5:
+                        self._last_game = f'{user_a.get_name()} - {user_b.get_name()} 1/2:1/2 ({date})'
+
+            def get_history(args: str = ''):
+                # HISTORY [name] [page], the games of the user by default
+                name, page = user_a.get_name(), 1
+                for arg in args.split():
+                    if arg.isdigit():
+                        page = max(int(arg), 1)
+                    else:
+                        name = arg
+                if page > GameArchive.MAX_PAGE:
+                    self._notify(user_a, f'%HISTORY [ {name} - page {page} ]\nat most {GameArchive.MAX_PAGE} pages')
+                    return
+                self._archive.request_history(name, page, lambda text: self._post(lambda: self._notify(user_a, text)))
+
+            commands = {
+                'LINK': link,
+                'LINKTO': link_to,
+                'FEEDBACK': feedback,
+                'ELO': get_elo_rating,
+                'SCORING': update_rating,
+                'DISCONNECT': disconnect,
+                'HISTORY': get_history,
+            }
+
+            arguments = msg.split(maxsplit=2)
+            if not arguments:
+                logging.info(f'{msg} - no arguments')
+            else:
+                try:
+                    command = arguments[1]
+                    if command in commands:
+                        t0 = time.time()
+                        if len(arguments) == 3:
+                            commands.get(command)(arguments[2])
+                        elif len(arguments) == 2:
+                            commands.get(command)()
+                        self.metrics.histogram('chess_command_seconds', 'handling of a %SERVER command',
+                                               command=command).observe(time.time() - t0)
+
+                except IndexError:
+                    logging.info('index error')
+
+        else:
+            recipient = None
+            if originator in self._linked_users:
+                recipient = self._linked_users[originator]
+
+            if recipient:
+                game = self._games.get(originator)
+                if game:
+                    game.add(game.white == originator.get_name(), msg)  # written by the archive thread
+                try:
+                    self._notify(recipient, msg)
+                except ConnectionError:
+                    logging.info('CONNECTION ERROR (NOTIFY ' + recipient.get_name() + ')')
+                    self._disconnected_users.add(recipient)
+                except OSError:
+                    logging.info('OS ERROR (NOTIFY ' + recipient.get_name() + ')')
+                    traceback.print_exc()
+                    self._disconnected_users.add(recipient)
+                except Exception as ex:
+                    logging.error(str(ex))
+            else:
                 try:
-                    result = self.execute(cmd)
-                    self._admin.notify(result)
+                    self._notify(originator, '%NOTE ' + string(NOT_LINKED))
                 except ConnectionError:
-                    logging.info('CONNECTION ERROR (NOTIFY ADMIN)')
-                    self._admin.get_socket.close()
-                    self._admin = None
+                    logging.info('CONNECTION ERROR (NOTIFY ' + originator.get_name() + ')')
+                    self._disconnected_users.add(originator)
                 except OSError as ex:
-                    logging.error('OS ERROR (NOTIFY ADMIN)')
+                    logging.error('OS ERROR (NOTIFY ' + originator.get_name() + ')')
+                    logging.error(str(ex))
+                    self._disconnected_users.add(originator)
+                except Exception as ex:
                     logging.error(str(ex))
-                    self._admin.get_socket.close()
-                    self._admin = None
 
-    def __link_users(self, user_a: User, user_b: User) -> None:
+    def _request_link(self, user: User) -> None:
+        # links the user with a waiting user of similar rating or lets the user wait
+        opponent = self._matchmaker.add(user, time.time())
+        if opponent:
+            self._link_users(user, opponent)
+
+    def _request_link_to(self, user_a: User, name: str) -> None:
+        user_b: T_User = self._get_online_user_by_name(name)
+        if user_b and user_b not in self._linked_users:
+            self._link_users(user_a, user_b)
+
+    def _rating_changed(self, user: User) -> None:
+        self._leaderboard.update(user.get_id(), user.get_name(), user.rating)
+        self._journal.add(user.to_row())  # on disk long before the next database update
+
+    def _start_game(self, white: User, black: User) -> None:
+        game = self._archive.start_game(white.get_name(), black.get_name())
+        self._games[white] = game
+        self._games[black] = game
+
+    def _end_game(self, user_a: User, user_b: User, scoring: typing.Union[float, None] = None) -> None:
+        # scoring of user_a, None if the game was aborted
+        game = self._games.pop(user_a, None)
+        self._games.pop(user_b, None)
+        if not game:
+            return
+        if scoring is not None and game.white != user_a.get_name():
+            scoring = 1.0 - scoring
+        self._archive.end_game(game, RESULTS.get(scoring, '*'))
+
+    def _link_users(self, user_a: User, user_b: User) -> None:
         new_link = {user_a: user_b,
                     user_b: user_a}
-        user_a.notify('%NAME ' + user_b.get_name())
-        user_a.notify('%NOTE ' + string(CONNECTED_WITH).format(user_b.get_name(), user_b.rating))
-        user_b.notify('%NAME ' + user_a.get_name())
-        user_b.notify('%NOTE ' + string(CONNECTED_WITH).format(user_a.get_name(), user_a.rating))
         try:
             self._users_to_link.remove(user_a)
         except KeyError:
@@ -660,88 +1342,115 @@ class Server:
             self._users_to_link.remove(user_b)
         except KeyError:
             logging.debug(f'user {user_b.get_name()} not in _users_to_link')
+        self._matchmaker.remove(user_a)
+        self._matchmaker.remove(user_b)
         self._linked_users.update(new_link)
 
-        user_a.notify(NEW_GAME)
-        user_b.notify(NEW_GAME)
-        if randint(0, 1):
-            user_a.notify(PLAY_WHITE)
-            user_b.notify(PLAY_BLACK)
-        else:
-            user_a.notify(PLAY_BLACK)
-            user_b.notify(PLAY_WHITE)
+        colors = (PLAY_WHITE, PLAY_BLACK) if randint(0, 1) else (PLAY_BLACK, PLAY_WHITE)
+        self._start_game(*((user_a, user_b) if colors[0] == PLAY_WHITE else (user_b, user_a)))
+        self._notify(user_a, '%NAME ' + user_b.get_name(),
+                     '%NOTE ' + string(CONNECTED_WITH).format(user_b.get_name(), user_b.rating),
+                     NEW_GAME, colors[0])
+        self._notify(user_b, '%NAME ' + user_a.get_name(),
+                     '%NOTE ' + string(CONNECTED_WITH).format(user_a.get_name(), user_a.rating),
+                     NEW_GAME, colors[1])
+
+    def _load_users(self) -> None:
+        # users are loaded on demand, see _get_user_by_name
+        self._reader = Database(self.DATABASE_FILENAME, check_same_thread=False)
+
+        def apply(rows: list, removed_ids: list) -> list:
+            return self._read(lambda db: db.apply_journal(rows, removed_ids))
+
+        # results of games which were not in the database yet when the server stopped, e.g. by a crash:
+        replayed = self._journal.replay(apply, self._journal_names(list(RatingJournal.get_segments(self.DATA_DIR))))
+        if replayed:
+            logging.info(f'replayed the journaled results of {replayed} users')
+        User.set_id(self._read(Database.get_max_id) + 1)
+        self._registered_users = self._read(Database.count)
+        self._leaderboard.load(self._read(Database.get_ratings))
+
+    def _load_users_or_stop(self) -> None:
+        # a server which cannot load its users stops. it does not update the database on the way out, as that
+        # would truncate a journal which was not replayed
+        try:
+            self._load_users()
+            self._users_loaded = True
+        except Exception as ex:
+            logging.critical(f'ERROR LOADING USERS - {str(ex)} - the server stops')
+            self._stop = True
+
+    def _journal_names(self, names: typing.List[str]) -> typing.List[str]:
+        # the journals replayed on startup, the server is the only writer of its data directory
+        return names
+
+    def _link_waiting_users(self) -> None:
+        # users with a close opponent are linked on request, this links users whose accepted gap has grown
+        for user_a, user_b in self._matchmaker.match(time.time()):
+            self._link_users(user_a, user_b)
 
     def __main_loop(self) -> None:
-        user: User
         last_link = 0.0
-        reversed_sort = True
-
-        db = Database(self.DATABASE_FILENAME)
-        users, max_id = db.get_users()
-        User.set_id(max_id + 1)
-        self._all_users.update(users)
-        db.close()
+        last_db_update = time.time()
+        try:
+            self._load_users_or_stop()
+        finally:
+            self.__loaded.set()  # the waiting handshakes go on, and are refused if the server stops
 
         while not self._stop:
+            # block until a socket is readable, new users arrive or the next link pass is due
+            select_timeout = Server.SELECT_TIMEOUT
+            if self.__arrivals or self.__messages_pending:
+                select_timeout = 0
+            elif len(self._users_to_link) > 1:
+                select_timeout = min(select_timeout, max(0.0, last_link + Matchmaker.MATCH_INTERVAL - time.time()))
+
+            events = self._selector.select(select_timeout)
             t0 = time.time()
-            for user in self._online_users:
-                try:
-                    user.receive_message()
-                except BlockingIOError:
-                    continue
-                except ConnectionError:
-                    logging.info('CONNECTION ERROR (RECEIVING DATA FROM ' + user.get_name() + ')')
-                    self._disconnected_users.add(user)
-                    continue
-                except OSError:
-                    logging.info('OS ERROR (RECEIVING DATA FROM ' + user.get_name() + ')')
-                    self._disconnected_users.add(user)
-                    traceback.print_exc()
-                    continue
-                except Exception as ex:
-                    logging.error(str(ex))
-
-            self.__remove_disconnected_users()
-            self.__process_messages()
-            self.__remove_disconnected_users()
+            for key, mask in events:
+                if key.data is None:
+                    self.__drain_wakeup()
+                elif mask & selectors.EVENT_READ:
+                    self.__receive(key.data)  # writable sockets are handled by __flush_users
+
+            self.__run_posted()
+            self._remove_disconnected_users()
+            self.__messages_pending = self.__process_messages()
+            self._remove_disconnected_users()
             self.__add_users()
+            self.__select_admin()
+            self._reap_idle_users(t0)
 
-            if time.time() - last_link > Server.LINK_INTERVAL:  # link players every LINK_INTERVAL seconds
-                reversed_sort = not reversed_sort
-                self._unlinked_users.clear()
-                self._unlinked_users.update(self._users_to_link - set(self._linked_users))
-                unlinked_list = list(self._unlinked_users)
-                # sort by rating. connect users with similarly high rating:
-                unlinked_list.sort(key=lambda c: c.rating, reverse=reversed_sort)
-                unlinked_count = len(unlinked_list)
-                for i in range(unlinked_count // 2):
-                    self.__link_users(unlinked_list[2 * i], unlinked_list[2 * i + 1])
+            # link players whose accepted rating gap has grown:
+            if len(self._users_to_link) > 1 and time.time() - last_link > Matchmaker.MATCH_INTERVAL:
+                self._link_waiting_users()
                 last_link = time.time()
 
-            self._admin: User
-            if self._admin:
-                try:
-                    self._admin.receive_message()
-                except BlockingIOError:
-                    pass
-                except ConnectionError:
-                    logging.info('CONNECTION ERROR (RECEIVING DATA FROM ADMIN)')
-                    self._admin.socket.close()
-                    self._admin = None
-                except OSError as ex:
-                    logging.error('OS ERROR (RECEIVING DATA FROM ADMIN)')
-                    logging.error(str(ex))
-                    self._admin.socket.close()
-                    self._admin = None
+            self.__flush_users()
+            self._remove_disconnected_users()
+
+            if time.time() - last_db_update > Server.DB_UPDATE_INTERVAL:
+                logging.info(self.execute('update'))  # queue database update
+                last_db_update = time.time()
 
-            t1 = time.time()
-            time_limit = 0.05
-            if t1 - t0 > time_limit:
+            cycle = time.time() - t0
+            self._cycle_seconds.observe(cycle)
+            if cycle > 0.05:
                 # loop cycle lasted more than 50ms - will most likely not happen
                 logging.info('time limit exceeded')
-                continue
-            else:
-                time.sleep(time_limit)
 
         logging.info(self.SOCKET_NAME + ' main loop interrupted')
-        logging.info(self.execute('update'))  # database update
+        self._admin_worker.shutdown()
+        self._stop_metrics_endpoint()
+        if self._users_loaded:
+            logging.info(self.execute('update'))  # database update
+        self._persistence.stop()
+        self._persistence.join()  # the journal is truncated once the update is written
+        self._journal.stop()
+        self._feedback.stop()
+        self._archive.stop()
+        if self._reader:
+            self._read(Database.close)
+        self._selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
@@ -17,7 +17,7 @@ TIMEOUT_ERROR = ['Error: connection timeout', 'Fehler: Zeitüberschreitung']
 AUTH_ERROR = ['Authentication failed', 'Fehler bei der Authentifizierung']
 TOO_MANY_IP = ['Too many users with same ip address', 'Zu viele Nutzer mit derselben IP-Adresse']
 
-BUFFER_SIZE = 256
+BUFFER_SIZE = 16384  # bytes read from a socket at once
 ETX = chr(0x03)  # ASCII 'end of text'
 SEPARATOR_LF = '---------------------------------------\n'
 SEPARATOR = '---------------------------------------'
@@ -1,14 +1,31 @@
 import os
+import shutil
+import socket
+import tempfile
 import threading
 import time
 import unittest
 import warnings
+from concurrent.futures import Future
 
+from chessServer import AsyncServer
 from chessServer import Client
 from chessServer import Server
+from chessServer.archive import GameArchive
+from chessServer.database import Database
+from chessServer.feedback import FeedbackStore
+from chessServer.framing import FrameBuffer
+from chessServer.journal import RatingJournal
+from chessServer.leaderboard import Leaderboard
+from chessServer.matchmaker import Matchmaker
+from chessServer.persistence import Persistence
+from chessServer.ratelimit import AcceptLimiter
+from chessServer.shared import ETX
+from chessServer.user import User
 
 
 class TestServer(unittest.TestCase):
+    server_class = Server
 
     def setUp(self):
         warnings.simplefilter('ignore', category=ResourceWarning)
@@ -16,7 +33,9 @@ class TestServer(unittest.TestCase):
         self.ip = '127.0.0.99'
         Server.LINK_INTERVAL = 0  # link users immediately
         Server.DB_UPDATE_INTERVAL = 1
-        self.server = Server(self.ip, self.port, 'auth', 'pw')
+        self.handshakes_per_ip = Server.HANDSHAKES_PER_IP
+        Server.HANDSHAKES_PER_IP = 10  # the clients connect at once from one address
+        self.server = self.server_class(self.ip, self.port, 'auth', 'pw')
         self.server.run()
         self.clients = list()
         time.sleep(0.1)
@@ -26,6 +45,9 @@ class TestServer(unittest.TestCase):
         self.register_clients()
         self.notify_clients()
         self.link_to_user()
+        self.request_history()
+        self.send_bad_bytes()
+        self.administrate()
 
     def choose_port(self):
         self.assertGreaterEqual(self.server.get_port(), self.port)
@@ -46,6 +68,9 @@ class TestServer(unittest.TestCase):
 
         time.sleep(0.3)
         self.assertEqual(10, len(self.server._all_users), 'users not registered correctly')
+        self.assertEqual(10, len(self.server._online_users_by_name), 'name index not updated')
+        self.assertEqual('client_3', self.server._get_user_by_name('client_3').get_name())
+        self.assertEqual(list(range(1, 11)), sorted(user.get_id() for user in self.server._all_users))
         self.assertEqual(len(self.server._linked_users), 4, 'users not linked correctly')
         self.assertEqual(len(self.server._users_to_link), 1, 'users not linked correctly')
 
@@ -72,10 +97,487 @@ class TestServer(unittest.TestCase):
         self.assertTrue(client_6.next_message().startswith('%NAME'))
         self.assertTrue(client_6.next_message().startswith('%NOTE'))
         self.assertTrue(client_6.next_message().startswith('%MOVE'))
+        client_7.send('%SERVER SCORING 1e20')  # refused, the users stay linked, see administrate
+
+    def request_history(self):
+        client_8 = self.clients[8]
+        self.assertEqual(client_8.next_message(), 'WELCOME client_8')
+        client_8.send('%SERVER HISTORY client_0')
+        self.assertTrue(client_8.next_message().startswith('%HISTORY [ client_0 - page 1 ]\n#'))
+        client_8.send('%SERVER HISTORY client_0 2')
+        self.assertTrue(client_8.next_message().endswith('no games on page 2'))
+        client_8.send('%SERVER HISTORY 99999999999999999999')
+        self.assertTrue(client_8.next_message().endswith(f'at most {GameArchive.MAX_PAGE} pages'))
+
+    def send_bad_bytes(self):
+        # a frame which is not valid utf-8 is read with replaced characters, the user stays connected
+        client_9 = self.clients[9]
+        client_9.socket.send(b'\xff\xfe' + ETX.encode('utf-8'))
+        client_9.send('%SERVER ELO')
+        self.assertTrue(client_9.next_message().startswith('%NOTE'))  # relayed, but client_9 is not linked
+        self.assertTrue(client_9.next_message().startswith('%ELO [ client_9 - 1000 ]'))
+
+    def administrate(self):
+        # 'links' runs on the admin worker against a snapshot, 'setlang' on the main loop
+        links, setlang = Future(), Future()
+        self.server._post(lambda: self.server._admin_command('links', links.set_result))
+        self.server._post(lambda: self.server._admin_command('setlang x', setlang.set_result))
+        self.assertIn('linked: 6 / unlinked: 4', links.result(timeout=5))
+        self.assertIn('ERROR', setlang.result(timeout=5))
+
+    def tearDown(self):
+        self.server.stop()
+        Server.HANDSHAKES_PER_IP = self.handshakes_per_ip
+
+        while threading.activeCount() > 2:
+            time.sleep(0.1)
+        os.remove(self.server.DATABASE_FILENAME)
+        os.remove(f'{self.server.DATA_DIR}/games.db')
+
+
+class TestAsyncServer(TestServer):
+    server_class = AsyncServer
+
+
+class ChunkSocket:
+    # replays data in chunks of the requested size like a socket with a full receive buffer, see also the
+    # framing benchmark
+
+    def __init__(self, data: bytes):
+        self.__data = data
+        self.__offset = 0
+
+    def recv(self, size: int) -> bytes:
+        chunk = self.__data[self.__offset:self.__offset + size]
+        self.__offset += size
+        return chunk
+
+
+class TestFrameBuffer(unittest.TestCase):
+
+    def runTest(self):
+        self.split_character()
+        self.invalid_bytes()
+        self.too_long()
+
+    def split_character(self):
+        text = 'x' * (FrameBuffer.RECEIVE_SIZE - 1) + 'üße'
+        skt = ChunkSocket((text + ETX).encode('utf-8'))
+        buffer = FrameBuffer()
+        buffer.receive(skt)  # RECEIVE_SIZE bytes, the ü is cut
+        self.assertIsNone(buffer.next_message())
+        while buffer.receive(skt):
+            pass
+        self.assertEqual(text, buffer.next_message())
+
+    def invalid_bytes(self):
+        buffer = FrameBuffer()
+        buffer.feed(('first' + ETX).encode('utf-8') + b'\xff\xfe' + ETX.encode('utf-8') + b'last' + ETX.encode('utf-8'))
+        self.assertEqual(['first', '\ufffd\ufffd', 'last'], buffer.messages())
+        buffer.feed(b'\xc3' + ETX.encode('utf-8'))
+        self.assertEqual('\ufffd', buffer.next_message())
+
+    def too_long(self):
+        # the buffer of a server ends the connection like the async server, a client takes any length
+        buffer = FrameBuffer(FrameBuffer.MAX_FRAME)
+        buffer.feed(b'x' * FrameBuffer.MAX_FRAME)
+        self.assertEqual([], buffer.messages())
+        buffer.feed(b'x')
+        self.assertRaises(ConnectionAbortedError, buffer.messages)
+        self.assertRaises(ConnectionAbortedError, buffer.next_message)
+        buffer = FrameBuffer()
+        buffer.feed(b'x' * (FrameBuffer.MAX_FRAME + 1) + ETX.encode('utf-8'))
+        self.assertEqual(FrameBuffer.MAX_FRAME + 1, len(buffer.next_message()))
+
+
+def row(user_id: int, name: str, games: int, rating: int) -> tuple:
+    # see User.to_row
+    return user_id, '127.0.0.1', name, 'pw', games, 0, 0, games, rating, 40, ''
+
+
+class TestRatingJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(f'{self.directory}/users.db')
+
+    def runTest(self):
+        self.db.update([row(1, 'alice', 1, 1000), row(2, 'bob', 5, 1100), row(3, 'carol', 2, 1000)], [])
+        journal = RatingJournal(self.directory)
+        journal.start()
+        journal.add(row(1, 'alice', 2, 1020))
+        journal.add(row(2, 'bob', 3, 1060))  # fewer games than the database row, e.g. written by another worker
+        journal.rotate()
+        journal.add(row(1, 'alice', 3, 1035))
+        journal.add_removal(3)
+        journal.add(row(4, 'dave', 1, 10 ** 22))  # out of the range of sqlite, skipped
+        journal.stop()
+        self.assertEqual([1, 2], sorted(RatingJournal.get_segments(self.directory)['journal']))
+        self.assertEqual(4, RatingJournal(self.directory).replay(self.db.apply_journal, ['journal']))
+        self.replay_segments()
+        self.keep_later_games()
+        self.honor_removals()
+        self.skip_bad_rows()
+
+    def replay_segments(self):
+        alice = self.db.get_user('alice')
+        self.assertEqual((3, 1035), (alice.played_games, alice.rating))
+        self.assertEqual(dict(), RatingJournal.get_segments(self.directory))
+
+    def keep_later_games(self):
+        bob = self.db.get_user('bob')
+        self.assertEqual((5, 1100), (bob.played_games, bob.rating))
+
+    def honor_removals(self):
+        self.assertIsNone(self.db.get_user('carol'))
+
+    def skip_bad_rows(self):
+        self.assertIsNone(self.db.get_user('dave'))
+        self.assertEqual(1035, self.db.get_user('alice').rating)  # written with the bad row
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+
+class Rated:
+    # a waiting player, see Matchmaker
+    def __init__(self, rating: int):
+        self.rating = rating
+
+
+class TestMatchmaker(unittest.TestCase):
+
+    def runTest(self):
+        self.pair_within_gap()
+        self.widen_gap()
+
+    def pair_within_gap(self):
+        matchmaker = Matchmaker(max_wait=30)
+        a, b = Rated(1000), Rated(1000 + Matchmaker.MIN_GAP)
+        self.assertIsNone(matchmaker.add(a, 0.0))
+        self.assertIs(a, matchmaker.add(b, 1.0))
+        self.assertEqual(0, len(matchmaker))
+
+    def widen_gap(self):
+        matchmaker = Matchmaker(max_wait=30)
+        a, b = Rated(1000), Rated(1300)
+        self.assertIsNone(matchmaker.add(a, 0.0))
+        self.assertIsNone(matchmaker.add(b, 0.0))
+        self.assertEqual([], matchmaker.match(1.0))
+        self.assertEqual([(a, b)], matchmaker.match(200 / Matchmaker.GAP_PER_SECOND))
+        c, d = Rated(1000), Rated(3000)
+        matchmaker.add(c, 0.0)
+        matchmaker.add(d, 0.0)
+        self.assertEqual([], matchmaker.match(29.0))
+        self.assertEqual([(c, d)], matchmaker.match(30.0))  # any opponent after max_wait
+        self.assertEqual(0, len(matchmaker))
+
+
+class TestLeaderboard(unittest.TestCase):
+
+    def runTest(self):
+        leaderboard = Leaderboard()
+        leaderboard.load([(1, 'alice', 1100), (2, 'bob', 1000), (3, 'carol', 1000), (4, 'dave', 900)])
+        self.assertEqual([1, 2, 2, 4], [leaderboard.rank(user_id) for user_id in range(1, 5)])
+        self.assertIsNone(leaderboard.rank(5))
+        leaderboard.update(4, 'dave', 1100)
+        self.assertEqual([1, 3, 3, 1], [leaderboard.rank(user_id) for user_id in range(1, 5)])
+        self.assertEqual([(1, 'alice', 1100), (4, 'dave', 1100)], leaderboard.top(2))
+
+
+class TestAcceptLimiter(unittest.TestCase):
+
+    def runTest(self):
+        # 1 connection per second, bursts of 2 per address, 3 per /24 network and 5 in total
+        limiter = AcceptLimiter((1.0, 2), (1.0, 3), (1.0, 5))
+        self.assertEqual(['', '', 'ip'], [limiter.check('10.0.0.1', 0.0) for _ in range(3)])
+        self.assertEqual(['', 'prefix'], [limiter.check(ip, 0.0) for ip in ('10.0.0.2', '10.0.0.3')])
+        self.assertEqual(['', '', 'global'], [limiter.check(ip, 0.0) for ip in ('10.0.1.1', '10.0.2.1', '10.0.3.1')])
+        self.assertEqual('', limiter.check('10.0.0.1', 1.0))  # a refused connection took no token
+        self.assertEqual('2001:db8::/64', AcceptLimiter.get_prefix('2001:db8::1'))
+
+
+class TestGameArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = GameArchive(f'{self.directory}/games.db')
+        self.archive.start()
+
+    def runTest(self):
+        for n in range(GameArchive.PAGE_SIZE + 2):
+            game = self.archive.start_game('alice', f'opponent_{n}')
+            game.add(True, '%MOVE 1')
+            self.archive.end_game(game, '1:0')
+        self.page_through()
+        self.survive_bad_page()
+
+    def history(self, name: str, page: int) -> str:
+        reply = Future()
+        self.archive.request_history(name, page, reply.set_result)
+        return reply.result(timeout=5)
+
+    def page_through(self):
+        size = GameArchive.PAGE_SIZE
+        first = self.history('alice', 1).split('\n')
+        self.assertEqual(size + 2, len(first))  # header, games and the hint
+        self.assertTrue(first[1].startswith(f'#{size + 2} alice - opponent_{size + 1} 1:0'))
+        self.assertEqual('next page: %SERVER HISTORY alice 2', first[-1])
+        self.assertEqual(3, len(self.history('alice', 2).split('\n')))
+        self.assertTrue(self.history('bob', 1).endswith('no games'))
+
+    def survive_bad_page(self):
+        self.archive.request_history('alice', 10 ** 20, lambda text: None)  # out of the range of sqlite
+        self.assertTrue(self.history('alice', 2).startswith('%HISTORY [ alice - page 2 ]'))
+        self.assertTrue(self.archive.is_alive())
+
+    def tearDown(self):
+        self.archive.stop()
+        shutil.rmtree(self.directory)
+
+
+class TestUserCache(unittest.TestCase):
+    # the server is not run, the users are cached and signed off like the main loop does
+
+    def setUp(self):
+        warnings.simplefilter('ignore', category=ResourceWarning)
+        self.size = Server.USER_CACHE_SIZE
+        Server.USER_CACHE_SIZE = 3
+        self.server = Server('127.0.0.96', 55855, 'auth', 'pw')
+
+    def runTest(self):
+        for n in range(1, 4):
+            self.cache(n)
+        self.evict_least_recently_used()
+        self.release_connection()
+
+    def cache(self, n: int) -> None:
+        self.server._cache_user(f'user_{n}', User.create_user(row(n, f'user_{n}', 1, 1000)))
+
+    def evict_least_recently_used(self):
+        self.server._cache_user('user_1', None)  # looked up, so user_2 is the least recently used
+        self.cache(4)
+        self.assertEqual(['user_3', 'user_1', 'user_4'], list(self.server._offline_users))
+        self.assertNotIn('user_2', self.server._users_by_name)
+        self.server._users_by_name['user_3'].dirty = True  # stays until the database is up to date
+        self.cache(5)
+        self.assertEqual(['user_3', 'user_4', 'user_5'], list(self.server._offline_users))
+
+    def release_connection(self):
+        skt, peer = socket.socketpair()
+        user = User(skt, '127.0.0.1')
+        user.assign_id()
+        user.set_name('online')
+        user.set_password('pw')
+        self.server.register_user(user)
+        user.queue('%ECHO?')
+        self.server.sign_off(user)
+        self.assertEqual((None, 0), (user.messages, user.pending_output()))  # the buffers of the connection
+        self.assertEqual(['user_3', 'user_5', 'online'], list(self.server._offline_users))
+        peer.close()
 
     def tearDown(self):
+        Server.USER_CACHE_SIZE = self.size
+        self.server._admin_worker.shutdown()
+        self.server._selector.close()
+        for skt in (self.server._server_socket, self.server._wakeup_receiver, self.server._wakeup_sender):
+            skt.close()
+        shutil.rmtree(self.server.DATA_DIR)
+
+
+class TestFeedbackStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FeedbackStore(f'{self.directory}/feedback.log')
+
+    def runTest(self):
+        for n in range(5):
+            self.store.add('alice' if n % 2 else 'bob', f'text {n}')
+        self.store.flush()
+        self.store.add('alice', 'pending')  # not yet written, found all the same
+        self.page_through()
+        self.filter_entries()
+        self.read_legacy_files()
+
+    def texts(self, *args, **kwargs) -> list:
+        return [text for _, _, text in self.store.query(*args, **kwargs)[1]]
+
+    def page_through(self):
+        total, _ = self.store.query(page_size=4)
+        self.assertEqual(6, total)
+        self.assertEqual(['pending', 'text 4', 'text 3', 'text 2'], self.texts(page=1, page_size=4))
+        self.assertEqual(['text 1', 'text 0'], self.texts(page=2, page_size=4))
+        self.assertEqual([], self.texts(page=3, page_size=4))
+
+    def filter_entries(self):
+        self.assertEqual(3, self.store.query('alice')[0])
+        self.assertEqual(['pending', 'text 3'], self.texts('alice', page_size=2))
+        self.assertEqual(['text 1'], self.texts('alice', page=2, page_size=2))
+        self.assertEqual([], self.texts(since=time.time() + 60))
+
+    def read_legacy_files(self):
+        # the files of earlier versions come first, a line cut by a crash is skipped
+        path = f'{self.directory}/{FeedbackStore.LEGACY_PREFIX}d01-02t03-04-05-carol.txt'
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('old')
+        os.utime(path, (1, 1))
+        with open(f'{self.directory}/feedback.log', 'a', encoding='utf-8') as file:
+            file.write('{"time": 1')
+        total, entries = self.store.query(page_size=10)
+        self.assertEqual(7, total)
+        self.assertEqual((1, 'carol', 'old'), entries[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestPersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.persistence = Persistence(f'{self.directory}/users.db')
+        self.persistence.start()
+
+    def runTest(self):
+        self.write_rows()
+        self.drop_bad_row()
+
+    def update(self, rows: list, removed_ids: list) -> bool:
+        # True if the update was written
+        written = Future()
+        self.persistence.update_users(rows, removed_ids, lambda: written.set_result(False),
+                                      lambda: written.set_result(True))
+        return written.result(timeout=5)
+
+    def read(self, name: str) -> tuple:
+        db = Database(f'{self.directory}/users.db')
+        user = db.get_user(name)
+        db.close()
+        return user and (user.played_games, user.rating)
+
+    def write_rows(self):
+        self.assertTrue(self.update([row(1, 'alice', 1, 1020), row(2, 'bob', 1, 980)], []))
+        self.assertTrue(self.update([row(1, 'alice', 2, 1035)], [2]))
+        self.assertEqual((2, 1035), self.read('alice'))
+        self.assertIsNone(self.read('bob'))
+
+    def drop_bad_row(self):
+        # a rating out of the range of sqlite does not hold up the other rows or the later updates
+        self.assertTrue(self.update([row(3, 'carol', 1, 10 ** 22), row(4, 'dave', 1, 990)], []))
+        self.assertTrue(self.update([row(5, 'eve', 0, 1000)], []))
+        self.assertEqual(((1, 990), (0, 1000)), (self.read('dave'), self.read('eve')))
+        self.assertIsNone(self.read('carol'))
+        self.assertEqual((0, 1), (self.persistence.failures, self.persistence.dropped))
+
+    def tearDown(self):
+        self.persistence.stop()
+        self.persistence.join()
+        shutil.rmtree(self.directory)
+
+
+class TestHandshakeLimit(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter('ignore', category=ResourceWarning)
+        self.timeout = Server.HANDSHAKE_TIMEOUT
+        Server.HANDSHAKE_TIMEOUT = 1
+        self.server = Server('127.0.0.98', 55655, 'auth', 'pw')
+        self.server.run()
+        self.sockets = list()
+        time.sleep(0.1)
+
+    def connect(self, source: str) -> socket.socket:
+        skt = socket.create_connection(('127.0.0.98', self.server.get_port()), source_address=(source, 0))
+        skt.settimeout(3)
+        self.sockets.append(skt)
+        return skt
+
+    def login(self, source: str, name: str) -> str:
+        skt = self.connect(source)
+        skt.sendall(f'auth{ETX}%NAME {name}{ETX}pw{ETX}'.encode('utf-8'))
+        buffer = FrameBuffer()
+        message = buffer.next_message()
+        while message is None:
+            self.assertTrue(buffer.receive(skt), 'connection closed')
+            message = buffer.next_message()
+        return message
+
+    def refused(self, source: str) -> bool:
+        try:
+            return self.connect(source).recv(1) == b''
+        except ConnectionResetError:
+            return True
+
+    def runTest(self):
+        for _ in range(Server.HANDSHAKES_PER_IP):
+            self.connect('127.0.0.3')  # sends nothing
+        time.sleep(0.1)
+        self.assertTrue(self.refused('127.0.0.3'))
+        self.assertEqual('WELCOME honest', self.login('127.0.0.4', 'honest'))
+        time.sleep(Server.HANDSHAKE_TIMEOUT + 0.5)  # the silent connections time out
+        self.assertEqual('WELCOME patient', self.login('127.0.0.3', 'patient'))
+
+    def tearDown(self):
+        for skt in self.sockets:
+            skt.close()
         self.server.stop()
+        Server.HANDSHAKE_TIMEOUT = self.timeout
+        while threading.activeCount() > 2:
+            time.sleep(0.1)
+        os.remove(self.server.DATABASE_FILENAME)
+        os.remove(f'{self.server.DATA_DIR}/games.db')
+
+
+class TestHeartbeat(unittest.TestCase):
+    server_class = Server
+
+    def setUp(self):
+        warnings.simplefilter('ignore', category=ResourceWarning)
+        self.intervals = Server.HEARTBEAT_INTERVAL, Server.IDLE_TIMEOUT
+        Server.HEARTBEAT_INTERVAL, Server.IDLE_TIMEOUT = 0.5, 1.5  # checked at least once per SELECT_TIMEOUT
+        self.server = self.server_class('127.0.0.97', 55755, 'auth', 'pw')
+        self.server.run()
+        time.sleep(0.1)
+
+    def runTest(self):
+        clients = [Client('127.0.0.97', self.server.get_port(), 'auth', name, 'pw', terminal_mode=False)
+                   for name in ('silent', 'answering')]
+        received = {'silent': list(), 'answering': list()}
+        for client in clients:
+            client.socket.settimeout(0.1)
+        # the silent client is signed off, the client which answers the heartbeats stays
+        connected = list(clients)
+        deadline = time.time() + 5
+        while connected and time.time() < deadline:
+            for client in list(connected):
+                try:
+                    message = client.next_message()
+                except socket.timeout:
+                    continue
+                received[client.name].append(message)
+                if not message:
+                    connected.remove(client)
+                    deadline = min(deadline, time.time() + Server.IDLE_TIMEOUT)  # the other one outlasts it
+                elif client.name == 'answering' and message == '%ECHO?':
+                    client.send('%ECHO')
+        self.assertEqual(['WELCOME silent', '%ECHO?', ''], received['silent'])
+        self.assertIn('%ECHO?', received['answering'])
+        self.assertNotIn('', received['answering'])
+        self.assertEqual(['answering'], list(self.server._online_users_by_name))
+        self.assertEqual(1, self.server._reaped.value)
+        for client in clients:
+            client.socket.close()
 
+    def tearDown(self):
+        self.server.stop()
+        Server.HEARTBEAT_INTERVAL, Server.IDLE_TIMEOUT = self.intervals
         while threading.activeCount() > 2:
             time.sleep(0.1)
         os.remove(self.server.DATABASE_FILENAME)
+        os.remove(f'{self.server.DATA_DIR}/games.db')
+
+
+class TestAsyncHeartbeat(TestHeartbeat):
+    server_class = AsyncServer
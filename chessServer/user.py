@@ -1,16 +1,38 @@
+import time
 import typing
+from collections import deque
 from datetime import datetime
 from socket import timeout
-from threading import Thread
-from typing import List
+from threading import Lock, Thread
 
+from chessServer.framing import FrameBuffer
 from chessServer.shared import *
 
 T_Socket = typing.Union[sock, None]
 
+LOGIN_FORMAT = '%Y.%m.%d.%H:%M:%S'  # of the LASTLOGIN column
+
+
+def format_login(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds).strftime(LOGIN_FORMAT)
+
+
+def parse_login(text: str) -> float:
+    try:
+        return datetime.strptime(text, LOGIN_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
 
 class User:
+    # there are many users in memory, most of them offline. the attributes are slots and the buffers of the
+    # connection only exist while the user is connected
+    __slots__ = ('played_games', 'scoring_zero', 'scoring_half', 'scoring_one', 'rating', 'socket', 'ip',
+                 'last_login', 'last_received', 'on_pending', 'messages', 'dirty',
+                 '__elo_weight', '__ID', '__NAME', '__password', '__buffer', '__out', '__out_lock')
     _id: int = 1
+    _id_step: int = 1  # workers of a cluster hand out interleaved ids
+    HIGH_WATER_MARK = 1 << 18  # unsent bytes of a client which does not read, it is disconnected then
 
     def __init__(self, user_socket: T_Socket, ip: str):
         self.played_games = 0
@@ -18,16 +40,36 @@ class User:
         self.scoring_half = 0  # number of drawn games
         self.scoring_one = 0  # number of games won
         self.rating = 1000
-        self.socket: T_Socket = user_socket
         self.ip: str = ip
-        self.last_login: str = datetime.now().strftime('%Y.%m.%d.%H:%M:%S')
+        self.last_login: float = time.time()  # seconds since the epoch, formatted for the database only
         self.__elo_weight = 40
-        self.__ID = User._id
+        self.__ID = 0  # a connection which is not yet admitted, see assign_id
         self.__NAME = ''
         self.__password = ''
-        self.__data = ''
-        self.messages: List[str] = list()
-        User._id += 1
+        self.on_pending: typing.Union[typing.Callable[['User'], None], None] = None  # called if output is left
+        self.dirty = True  # changed since the last database update
+        self.__connect(user_socket)
+
+    def __connect(self, skt: T_Socket) -> None:
+        # the buffers of a connection, see release_connection
+        self.socket: T_Socket = skt
+        online = skt is not None
+        self.last_received = time.time() if online else 0.0  # see Server.IDLE_TIMEOUT
+        self.__buffer = FrameBuffer(FrameBuffer.MAX_FRAME) if online else None
+        self.__out = bytearray() if online else None  # queued messages not yet taken by the socket
+        self.__out_lock = Lock() if online else None
+        self.messages: typing.Deque[str] = deque() if online else None
+
+    def release_connection(self) -> None:
+        # drops the buffers of the connection when the user goes offline. output queued later is discarded
+        out_lock = self.__out_lock
+        if out_lock is None:
+            return
+        with out_lock:
+            self.__out = None
+        self.__buffer = None
+        self.__out_lock = None
+        self.messages = None
 
     def __eq__(self, other):
         return self.__ID == other.get_id()
@@ -49,24 +91,56 @@ class User:
 
     @staticmethod
     def create_user(attr: tuple):
-        user = User(None, '')
+        # an offline user loaded from the database. does not take an id
+        user = User.__new__(User)
         # ID, IP, NAME, PW, GAMES, ZERO, HALF, ONE, RATING, WEIGHT, LASTLOGIN from USERS :
         [user.__ID, user.ip, user.__NAME, user.__password,
          user.played_games, user.scoring_zero, user.scoring_half, user.scoring_one,
-         user.rating, user.__elo_weight, user.last_login] = attr
+         user.rating, user.__elo_weight, last_login] = attr
+        user.last_login = parse_login(last_login)
+        user.on_pending = None
+        user.dirty = False
+        user.__connect(None)
         return user
 
+    def to_row(self) -> tuple:
+        # ID, IP, NAME, PW, GAMES, ZERO, HALF, ONE, RATING, WEIGHT, LASTLOGIN
+        return (self.__ID, self.ip, self.__NAME, self.__password,
+                self.played_games, self.scoring_zero, self.scoring_half, self.scoring_one,
+                self.rating, self.__elo_weight, format_login(self.last_login))
+
+    def take_row(self, stored: 'User') -> None:
+        # takes the attributes of the user read from the database, e.g. written by another worker of a cluster
+        self.__password = stored.__password
+        self.played_games = stored.played_games
+        self.scoring_zero = stored.scoring_zero
+        self.scoring_half = stored.scoring_half
+        self.scoring_one = stored.scoring_one
+        self.rating = stored.rating
+        self.__elo_weight = stored.__elo_weight
+
+    def assign_id(self) -> None:
+        # a new user takes the next id when it is admitted, on the main loop after the ids are loaded
+        self.__ID = User._id
+        User._id += User._id_step
+
     @staticmethod
-    def set_id(_id: int) -> None:
+    def set_id(_id: int, step: int = 1) -> None:
         User._id = _id
+        User._id_step = step
 
     def __recv(self) -> str:
-        return self.socket.recv(BUFFER_SIZE).decode()
+        return self.socket.recv(BUFFER_SIZE).decode(errors='replace')
 
-    def renew_connection(self, skt: sock, ip: str, date: str) -> None:
-        self.socket = skt
+    def renew_connection(self, skt: sock, ip: str, login: float) -> None:
+        self.__connect(skt)  # new buffers, output left from the previous connection is dropped
         self.ip = ip
-        self.last_login = date
+        self.last_login = login
+        self.dirty = True
+
+    def take_buffer(self, other: 'User') -> None:
+        # takes over data the admittance has already received, e.g. messages sent right after the password
+        self.__buffer.take(other.__buffer)
 
     def set_name(self, name: str) -> None:
         if not self.__NAME:
@@ -77,14 +151,17 @@ class User:
     def set_password(self, pw: str) -> None:
         if not self.__password:
             self.__password = pw
+            self.dirty = True
         elif self.__password == '%RESET_PASSWORD':
             self.__password = pw
+            self.dirty = True
             print(f'{self.__NAME} password reset')
         else:
             print('user password can not be changed')
 
     def reset_password(self) -> None:
         self.__password = '%RESET_PASSWORD'
+        self.dirty = True
 
     def set_timeout(self, time_out: float) -> None:
         self.socket.settimeout(time_out)
@@ -104,35 +181,92 @@ class User:
     def dec_elo_weight(self) -> None:
         if self.__elo_weight > 11:
             self.__elo_weight -= 2
+            self.dirty = True
+
+    def add_result(self, rating: int, scoring: float) -> None:
+        self.rating = rating
+        self.played_games += 1
+        if scoring == 0.0:
+            self.scoring_zero += 1
+        elif scoring == 1.0:
+            self.scoring_one += 1
+        else:
+            self.scoring_half += 1
+        self.dec_elo_weight()
+        self.dirty = True
+
+    def notify(self, *messages: str) -> int:
+        # sends the messages with one write. the part the socket does not take is left for on_pending.
+        # returns the number of bytes
+        queued = self.queue(*messages)
+        if not self.flush() and self.on_pending:
+            self.on_pending(self)
+        return queued
+
+    def queue(self, *messages: str) -> int:
+        return self.queue_frames(''.join(msg + ETX for msg in messages).encode('utf-8'))
 
-    def notify(self, msg: str) -> None:
-        self.socket.send((msg + ETX).encode('utf-8'))
+    def queue_frames(self, data: bytes) -> int:
+        # queues messages which are already encoded, e.g. a broadcast which is encoded once for all users
+        out_lock = self.__out_lock
+        if out_lock is None:
+            return 0  # offline
+        with out_lock:
+            if self.__out is None:
+                return 0
+            self.__out += data
+        return len(data)
+
+    def flush(self) -> bool:
+        # sends the queued messages and returns True if nothing is left
+        out_lock = self.__out_lock
+        if out_lock is None:
+            return True  # offline
+        with out_lock:
+            while self.__out:
+                try:
+                    sent = self.socket.send(self.__out)
+                except BlockingIOError:
+                    return False  # the socket buffer is full
+                del self.__out[:sent]
+            return True
+
+    def pending_output(self) -> int:
+        out = self.__out
+        return len(out) if out is not None else 0
 
     def receive_message(self) -> str:
+        # blocks until a message is received and queues it with the other buffered messages
         msg = self.next_message()
         if msg:
             self.messages.append(msg)
+            self.collect_messages()
         return msg
 
+    def receive_messages(self) -> typing.Tuple[int, int]:
+        # reads once from a readable socket and queues every complete message. returns the bytes read and
+        # the number of queued messages
+        received = self.__buffer.receive(self.socket)
+        if not received:
+            raise ConnectionAbortedError('connection closed by peer')
+        return received, self.collect_messages()
+
+    def collect_messages(self) -> int:
+        # queues the complete messages which are already buffered, e.g. after the admittance
+        count = 0
+        for msg in self.__buffer.messages():
+            if msg:
+                self.messages.append(msg)
+                count += 1
+        return count
+
     def next_message(self) -> str:
-        msg = self.__next_message()
+        msg = self.__buffer.next_message()
         if not msg:
-            self.__data += self.__recv()
-            return self.__next_message()
+            self.__buffer.receive(self.socket)
+            return self.__buffer.next_message() or ''
         return msg
 
-    def __next_message(self) -> str:
-        count = self.__data.count(ETX)
-        if count == 0:
-            return ''
-        split = self.__data.split(ETX, maxsplit=1)
-        if len(split) == 2:
-            self.__data = split[1]
-            return split[0]
-        elif len(split) == 1:
-            self.__data = ''
-            return split[0]
-
     def error(self, message: str) -> None:
         self.socket.settimeout(1)
         th = Thread(target=self.__error, args=(message,), name='id_' + str(self.__ID) + '_error')
@@ -1,20 +1,47 @@
 import logging
 import sys
+import threading
 
+from chessServer import AsyncServer
 from chessServer import Server
+from chessServer import Supervisor
 from chessServer import get_local_ip
 
 if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO)
 
+    server_class = Server
+    if '--asyncio' in sys.argv:
+        sys.argv.remove('--asyncio')
+        server_class = AsyncServer
+
+    if '--metrics' in sys.argv:
+        index = sys.argv.index('--metrics')
+        try:
+            Server.METRICS_PORT = int(sys.argv[index + 1])
+        except (IndexError, ValueError):
+            print('--metrics needs the port of the metrics endpoint')
+            exit(-1)
+        del sys.argv[index:index + 2]
+
+    workers = 0
+    if '--workers' in sys.argv:
+        index = sys.argv.index('--workers')
+        try:
+            workers = int(sys.argv[index + 1])
+        except (IndexError, ValueError):
+            print('--workers needs the number of worker processes')
+            exit(-1)
+        del sys.argv[index:index + 2]
+
     if len(sys.argv) > 5:
         print('too many arguments')
-        print('args: authentication, admin_authentication, port, ip')
+        print('args: authentication, admin_authentication, port, ip [--asyncio | --workers n] [--metrics port]')
         exit(-1)
     elif len(sys.argv) < 2:
         print('too few arguments')
-        print('args: authentication, admin_authentication, port, ip')
+        print('args: authentication, admin_authentication, port, ip [--asyncio | --workers n] [--metrics port]')
         exit(-1)
 
     server_arguments = [_authentication, _admin_authentication, _port, _ip] = [None, None, None, None]
@@ -35,5 +62,12 @@ if __name__ == '__main__':
     print('admin authentication:')
     print('*' * len(_admin_authentication))
 
-    server = Server(_ip, _port, _authentication, _admin_authentication)
-    server.run()
+    if workers > 1:
+        Supervisor(_ip, _port, _authentication, _admin_authentication, workers).run()
+    else:
+        server = server_class(_ip, _port, _authentication, _admin_authentication)
+        server.run()
+        # the handshake pool refuses new work once the main thread has finished, so wait for the server threads:
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join()